@@ -1,31 +1,33 @@
 import sys
+import array
 import functools
 import typing as T # noqa
 
-from PySide6.QtCore import Qt, Slot, QModelIndex
+from PySide6.QtCore import Qt, Slot, QModelIndex, QAbstractTableModel, QAbstractListModel
 from PySide6.QtGui import QPainter
 from PySide6.QtWidgets import (
     QDialogButtonBox,
-    QTableWidgetItem,
     QApplication,
-    QTableWidget,
+    QTableView,
     QFormLayout,
     QHeaderView,
     QHBoxLayout,
     QMainWindow,
     QPushButton,
     QVBoxLayout,
-    QListWidget,
+    QListView,
     QLineEdit,
     QDialog,
     QWidget
 )
 from PySide6.QtCharts import QChartView, QPieSeries, QChart
 
+from database import UserItems, Item
+
 
 if T.TYPE_CHECKING:
     from PySide6.QtWidgets import QWidget
-    from database import AppDatabase, Value
+    from database import AppDatabase
 
     # QWidget or it subclasses
     QType = T.Union[T.NewType('QSubType', QWidget), QWidget]
@@ -48,24 +50,102 @@ def add_on_destroy_callback(
     return widget
 
 
-class Widget(QWidget):
-    items: int = 0
+class ItemsModel(QAbstractTableModel):
+    """
+    Table model over compact arrays of items descriptions and prices.
+    """
+    headers = ("Description", "Price")
 
+    _descriptions: T.List[str]
+    _prices: array.array
+    _rows: T.Dict[str, int]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._descriptions = []
+        self._prices = array.array('d')
+        self._rows = {}
+
+    @property
+    def descriptions(self) -> T.List[str]:
+        return self._descriptions
+
+    @property
+    def prices(self) -> array.array:
+        return self._prices
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:  # noqa
+        return 0 if parent.isValid() else len(self._descriptions)
+
+    def columnCount(self, parent: QModelIndex = QModelIndex()) -> int:  # noqa
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole) -> T.Any:
+        if not index.isValid():
+            return None
+
+        if role == Qt.DisplayRole:
+            if index.column() == 0:
+                return self._descriptions[index.row()]
+            return f"{self._prices[index.row()]:.2f}"
+        if role == Qt.TextAlignmentRole and index.column() == 1:
+            return int(Qt.AlignRight | Qt.AlignVCenter)
+        return None
+
+    def headerData(self, section: int, orientation: Qt.Orientation, role: int = Qt.DisplayRole) -> T.Any:  # noqa
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return None
+
+    def set_items(self, data: 'UserItems'):
+        self.beginResetModel()
+        self._descriptions = [item.description for item in data.items]
+        self._prices = array.array('d', (item.price for item in data.items))
+        self._rows = {desc: row for row, desc in enumerate(self._descriptions)}
+        self.endResetModel()
+
+    def add_items(self, data: 'UserItems'):
+        """
+        Replaces items with existing descriptions and appends new ones in one rows insertion.
+        """
+        new_items = []
+        for item in data.items:
+            row = self._rows.get(item.description)
+            if row is None:
+                new_items.append(item)
+            else:
+                self._prices[row] = item.price
+                self.dataChanged.emit(self.index(row, 1), self.index(row, 1))
+
+        if not new_items:
+            return
+
+        first = len(self._descriptions)
+        self.beginInsertRows(QModelIndex(), first, first + len(new_items) - 1)
+        for row, item in enumerate(new_items, first):
+            self._descriptions.append(item.description)
+            self._prices.append(item.price)
+            self._rows[item.description] = row
+        self.endInsertRows()
+
+    def clear(self):
+        self.set_items(UserItems())
+
+
+class Widget(QWidget):
     _db: 'AppDatabase'
-    _data: T.Dict[str, 'Value']
     _doc_id: str
 
     def __init__(self, parent, database: 'AppDatabase', doc_id: str):
         super().__init__(parent)
 
         self._db = database
-        self._data = database.get_data_by_id(doc_id)
         self._doc_id = doc_id
 
         # Left
-        self.table = QTableWidget()
-        self.table.setColumnCount(2)
-        self.table.setHorizontalHeaderLabels(["Description", "Price"])
+        self.model = ItemsModel(self)
+        self.table = QTableView()
+        self.table.setModel(self.model)
         self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
 
         # Chart
@@ -107,32 +187,22 @@ class Widget(QWidget):
         self.description.textChanged.connect(self.check_disable)
         self.price.textChanged.connect(self.check_disable)
 
-        # Fill example data
+        # Fill user data
         self.fill_table()
 
     @Slot()
     def add_element(self):
-        des = self.description.text()
-        price = float(self.price.text())
+        data = UserItems(Item(
+            description=self.description.text(),
+            price=float(self.price.text())
+        ))
 
-        self._db.add_data_by_id(
-            user_id=self._doc_id,
-            **{des: price}
-        )
-
-        self.table.insertRow(self.items)
-        description_item = QTableWidgetItem(des)
-        price_item = QTableWidgetItem(f"{price:.2f}")
-        price_item.setTextAlignment(Qt.AlignRight)
-
-        self.table.setItem(self.items, 0, description_item)
-        self.table.setItem(self.items, 1, price_item)
+        self._db.upsert_data_by_id(self._doc_id, data)
+        self.model.add_items(data)
 
         self.description.clear()
         self.price.clear()
 
-        self.items += 1
-
     @Slot()
     def check_disable(self):
         enabled = bool(self.description.text() and self.price.text())
@@ -140,39 +210,69 @@ class Widget(QWidget):
 
     @Slot()
     def plot_data(self):
-        # Get table information
         series = QPieSeries()
-        for i in range(self.table.rowCount()):
-            text = self.table.item(i, 0).text()
-            number = float(self.table.item(i, 1).text())
-            series.append(text, number)
+        for desc, price in zip(self.model.descriptions, self.model.prices):
+            series.append(desc, price)
 
         chart = QChart()
         chart.addSeries(series)
         chart.legend().setAlignment(Qt.AlignLeft)
         self.chart_view.setChart(chart)
 
-    def fill_table(self, data: T.Dict[str, T.Iterable[T.Any]] = None):
+    def fill_table(self, data: 'UserItems' = None):
         if data is None:
-            data = self._data
-
-        for desc, price in data.items():
-            description_item = QTableWidgetItem(desc)
-            price_item = QTableWidgetItem(f"{price:.2f}")
-            price_item.setTextAlignment(Qt.AlignRight)
-            self.table.insertRow(self.items)
-            self.table.setItem(self.items, 0, description_item)
-            self.table.setItem(self.items, 1, price_item)
-            self.items += 1
+            data = self._db.get_data_by_id(self._doc_id)
+        self.model.set_items(data)
 
     @Slot()
     def clear_table(self):
-        self.table.setRowCount(0)
-        self.items = 0
+        self.model.clear()
+
+
+class UsersModel(QAbstractListModel):
+    """
+    List model of users, which loads next page of users only when view scrolls to the end of loaded ones.
+    """
+    _db: 'AppDatabase'
+    _users: T.List[str]
+    _exhausted: bool = False
+
+    def __init__(self, database: 'AppDatabase', batch_size: int = 50, parent=None):
+        super().__init__(parent)
+        self._db = database
+        self._users = []
+        self.batch_size = batch_size
+
+    def user(self, row: int) -> str:
+        return self._users[row]
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:  # noqa
+        return 0 if parent.isValid() else len(self._users)
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole) -> T.Any:
+        if index.isValid() and role == Qt.DisplayRole:
+            return self._users[index.row()]
+        return None
+
+    def canFetchMore(self, parent: QModelIndex = QModelIndex()) -> bool:  # noqa
+        return not parent.isValid() and not self._exhausted
+
+    def fetchMore(self, parent: QModelIndex = QModelIndex()) -> None:  # noqa
+        if parent.isValid():
+            return
+
+        # Cursor is the last loaded user, so next page is found by index seek instead of skip
+        users = self._db.iter_users_after(self._users[-1] if self._users else None, self.batch_size)
+        self._exhausted = len(users) < self.batch_size
+
+        if users:
+            first = len(self._users)
+            self.beginInsertRows(QModelIndex(), first, first + len(users) - 1)
+            self._users += users
+            self.endInsertRows()
 
 
 class ChangeDialog(QDialog):
-    _row_index2doc: T.Dict[int, T.Any] = {}
     current_row: int
     current_item: str
 
@@ -189,7 +289,9 @@ class ChangeDialog(QDialog):
         self.newdocDialog = NewDocDialog(self)
         self.newdocDialog = add_on_destroy_callback(self.newdocDialog, newdoc_destroy_callback) # noqa
 
-        self.listView = QListWidget(self)
+        self.usersModel = UsersModel(database, parent=self)
+        self.listView = QListView(self)
+        self.listView.setModel(self.usersModel)
         self.listView.clicked.connect(self.list_widget_item_clicked)
         self.buttonBox = QDialogButtonBox(self)
 
@@ -207,20 +309,13 @@ class ChangeDialog(QDialog):
 
         self.selectBtn.setEnabled(False)
 
-        index = 0
-        for batch in database.iter_all_users(n=10):
-            for row, doc in enumerate(batch):
-                self._row_index2doc[index+row] = doc
-                self.listView.insertItem(index+row, doc)
-            index += len(batch)
-
         layout = QVBoxLayout(self)
         layout.addWidget(self.listView)
         layout.addWidget(self.buttonBox)
         self.setLayout(layout)
 
     def select(self) -> None:
-        self.current_item = self._row_index2doc[self.current_row]
+        self.current_item = self.usersModel.user(self.current_row)
         self.destroy()
 
     def cancel(self) -> None:
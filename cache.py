@@ -0,0 +1,411 @@
+import json
+import sqlite3
+import logging
+import threading
+
+import typing as T  # noqa
+
+from datetime import datetime
+from httpx import RequestError
+from database import (
+    AppDatabase, ResponseError, UserItems, UserSummary, Operation, SortKey,
+    check_sort_key, encode_time, ops_to_list, ops_from_list, PRICE_SCALE
+)
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS items (
+    user_id TEXT NOT NULL,
+    description TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    price INTEGER NOT NULL,
+    PRIMARY KEY (user_id, description)
+);
+-- Writes which are not sent to remote database yet, in order of their calls
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    method TEXT NOT NULL,
+    args TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+"""
+SORT_COLUMNS = {'time': 'time', 'price': 'price', 'description': 'description'}
+# Client error statuses after which write may succeed, server answers 404 on any failure (e.g. database is down)
+RETRY_STATUSES = (404, 408, 429)
+
+
+def is_rejected(ex: ResponseError) -> bool:
+    """
+    Whether remote definitely rejected request, so it will never succeed.
+    """
+    return 400 <= ex.status_code < 500 and ex.status_code not in RETRY_STATUSES
+
+
+class CachedDatabase(AppDatabase):
+    """
+    Offline-first database, all reads are served from local SQLite file and writes are applied to it
+    and queued in outbox. Background thread sends queued writes to `remote` database in order
+    and refreshes cached items of read users, while `remote` is unreachable or failing writes stay queued
+    and syncs are retried with exponential backoff up to `sync_interval`.
+    Users list is refreshed by the sync after its first page is read, so listing shows users of the previous refresh.
+    Items are stored in the same encoding as `UserItems.to_dict`.
+    """
+    sync_interval: float
+    max_attempts: int
+    retry_delay: float = 1.0
+    page_size: int = 100
+    close_timeout: float = 5.0
+
+    _remote: AppDatabase
+    _conn: sqlite3.Connection
+    _lock: threading.Lock
+    _wake: threading.Event
+    _stop: threading.Event
+    # users which items are kept fresh, with their change listeners
+    _watched: T.Dict[str, T.List[T.Callable[[T.List[Operation] | None], None]]]
+    _unsubscribes: T.Dict[str, T.Callable[[], None]]
+    _users_stale: bool = True
+
+    def __init__(self, remote: AppDatabase, path: str, sync_interval: float = 30.0, max_attempts: int = 5):
+        """
+        Queued write definitely rejected by `remote` is dropped,
+        write failing with local error (e.g. corrupted queue entry) is dropped after `max_attempts` syncs.
+        """
+        self._remote = remote
+        self.sync_interval = sync_interval
+        self.max_attempts = max_attempts
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(SCHEMA)
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._watched = {}
+        self._unsubscribes = {}
+        self._thread = threading.Thread(target=self._sync_loop, daemon=True)
+        self._thread.start()
+
+    def _query(self, sql: str, params: T.Sequence[T.Any] = ()) -> T.List[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _write(self, user_id: str, method: str, args: T.Any, apply: T.Callable[[sqlite3.Connection], None]) -> None:
+        """
+        Applies write to cache and queues it for remote in one transaction.
+        """
+        with self._lock, self._conn:
+            self._conn.execute('BEGIN')
+            apply(self._conn)
+            self._conn.execute(
+                'INSERT INTO outbox (user_id, method, args) VALUES (?, ?, ?)',
+                (user_id, method, json.dumps(args))
+            )
+        self._wake.set()
+
+    @staticmethod
+    def _set_items(conn: sqlite3.Connection, user_id: str, data: UserItems) -> None:
+        conn.executemany(
+            'INSERT OR REPLACE INTO items (user_id, description, time, price) VALUES (?, ?, ?, ?)',
+            [(user_id, desc, time, price) for desc, (time, price) in data.to_dict().items()]
+        )
+
+    @staticmethod
+    def _unset_items(conn: sqlite3.Connection, user_id: str, fields: T.Iterable[str]) -> None:
+        conn.executemany('DELETE FROM items WHERE user_id = ? AND description = ?', [(user_id, f) for f in fields])
+
+    @staticmethod
+    def _user_exists(conn: sqlite3.Connection, user_id: str) -> bool:
+        return conn.execute('SELECT 1 FROM users WHERE user_id = ?', (user_id,)).fetchone() is not None
+
+    def create_user(self, user_id: str, init_data: UserItems | None = None) -> None:
+        data = UserItems() if init_data is None else init_data
+
+        def apply(conn: sqlite3.Connection):
+            conn.execute('INSERT INTO users (user_id) VALUES (?)', (user_id,))
+            self._set_items(conn, user_id, data)
+
+        # Replay of creation must not fail if remote already got it before connection was lost
+        self._write(user_id, 'upsert_data_by_id', data.to_dict(), apply)
+
+    def delete_user(self, user_id: str) -> None:
+        def apply(conn: sqlite3.Connection):
+            conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM items WHERE user_id = ?', (user_id,))
+
+        self._write(user_id, 'delete_user', None, apply)
+
+    def add_data_by_id(self, user_id: str, data: UserItems) -> None:
+        def apply(conn: sqlite3.Connection):
+            # Items of unknown users are ignored
+            if self._user_exists(conn, user_id):
+                self._set_items(conn, user_id, data)
+
+        self._write(user_id, 'add_data_by_id', data.to_dict(), apply)
+
+    def upsert_data_by_id(self, user_id: str, data: UserItems) -> None:
+        def apply(conn: sqlite3.Connection):
+            conn.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,))
+            self._set_items(conn, user_id, data)
+
+        self._write(user_id, 'upsert_data_by_id', data.to_dict(), apply)
+
+    def delete_data_by_id(self, user_id: str, fields: T.List[str]) -> None:
+        self._write(user_id, 'delete_data_by_id', list(fields), lambda conn: self._unset_items(conn, user_id, fields))
+
+    def apply_ops(self, user_id: str, ops: T.List[Operation]) -> None:
+        def apply(conn: sqlite3.Connection):
+            for op, arg in ops:
+                if op == 'set':
+                    if self._user_exists(conn, user_id):
+                        self._set_items(conn, user_id, arg)
+                else:
+                    self._unset_items(conn, user_id, arg)
+
+        self._write(user_id, 'apply_ops', ops_to_list(ops), apply)
+
+    def get_data_by_id(
+        self,
+        user_id: str,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        limit: int | None = None
+    ) -> UserItems:
+        self._watch(user_id)
+
+        sql = 'SELECT description, time, price FROM items WHERE user_id = ?'
+        params: T.List[T.Any] = [user_id]
+        if since is not None:
+            sql += ' AND time >= ?'
+            params.append(encode_time(since))
+        if until is not None:
+            sql += ' AND time <= ?'
+            params.append(encode_time(until))
+        if min_price is not None:
+            sql += ' AND price >= ?'
+            params.append(min_price * PRICE_SCALE)
+        if max_price is not None:
+            sql += ' AND price <= ?'
+            params.append(max_price * PRICE_SCALE)
+        if limit is not None:
+            sql += ' ORDER BY time DESC LIMIT ?'
+            params.append(limit)
+
+        return UserItems.from_dict({desc: (time, price) for desc, time, price in self._query(sql, params)})
+
+    def get_items_page(
+        self,
+        user_id: str,
+        page: int,
+        page_size: int,
+        sort_key: SortKey = 'time',
+        sort_desc: bool = False
+    ) -> T.Tuple[UserItems, int]:
+        check_sort_key(sort_key)
+        self._watch(user_id)
+
+        order = f"{SORT_COLUMNS[sort_key]} {'DESC' if sort_desc else 'ASC'}, description"
+        rows = self._query(
+            f'SELECT description, time, price FROM items WHERE user_id = ? ORDER BY {order} LIMIT ? OFFSET ?',
+            (user_id, page_size, page*page_size)
+        )
+        total, = self._query('SELECT COUNT(*) FROM items WHERE user_id = ?', (user_id,))[0]
+        return UserItems.from_dict({desc: (time, price) for desc, time, price in rows}), total
+
+    def get_summary(self, user_id: str) -> UserSummary:
+        self._watch(user_id)
+
+        count, total, min_price, max_price = self._query(
+            'SELECT COUNT(*), TOTAL(price), MIN(price), MAX(price) FROM items WHERE user_id = ?', (user_id,)
+        )[0]
+        return UserSummary(
+            count=count,
+            total=total / PRICE_SCALE,
+            min_price=None if min_price is None else min_price / PRICE_SCALE,
+            max_price=None if max_price is None else max_price / PRICE_SCALE
+        )
+
+    def iter_all_users(self, pid: int, n: int) -> T.List[str]:
+        if pid == 0:
+            self._refresh_users()
+        rows = self._query('SELECT user_id FROM users ORDER BY user_id LIMIT ? OFFSET ?', (n, pid*n))
+        return [user_id for user_id, in rows]
+
+    def iter_users_after(self, after: str | None, n: int) -> T.List[str]:
+        if after is None:
+            self._refresh_users()
+        rows = self._query('SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?', (after or '', n))
+        return [user_id for user_id, in rows]
+
+    def subscribe(
+        self,
+        user_id: str,
+        on_change: T.Callable[[T.List[Operation] | None], None]
+    ) -> T.Callable[[], None]:
+        """
+        `on_change` is called from sync thread with `None` each time cached user data is refreshed from remote.
+        Returns function which stops listening.
+        """
+        self._watch(user_id)
+        with self._lock:
+            self._watched[user_id].append(on_change)
+
+        def unsubscribe():
+            with self._lock:
+                if on_change in self._watched.get(user_id, []):
+                    self._watched[user_id].remove(on_change)
+
+        return unsubscribe
+
+    def _refresh_users(self) -> None:
+        self._users_stale = True
+        self._wake.set()
+
+    def _watch(self, user_id: str) -> None:
+        with self._lock:
+            if user_id in self._watched:
+                return
+            self._watched[user_id] = []
+
+        # Remote changes made by other clients are pulled on next sync
+        subscribe = getattr(self._remote, 'subscribe', None)
+        if subscribe is not None:
+            self._unsubscribes[user_id] = subscribe(user_id, lambda ops: self._wake.set())
+        self._wake.set()
+
+    def sync(self) -> bool:
+        """
+        Sends queued writes to remote and refreshes cache. Returns False if remote is unreachable or failed.
+        """
+        try:
+            self._push()
+            self._pull()
+        except RequestError:
+            return False
+        return True
+
+    def _push(self) -> None:
+        while True:
+            rows = self._query('SELECT id, user_id, method, args, attempts FROM outbox ORDER BY id LIMIT 1')
+            if not rows:
+                return
+            entry_id, user_id, method, args, attempts = rows[0]
+            args = json.loads(args)
+
+            try:
+                match method:
+                    case 'delete_user':
+                        self._remote.delete_user(user_id)
+                    case 'add_data_by_id' | 'upsert_data_by_id':
+                        getattr(self._remote, method)(user_id, UserItems.from_dict(args))
+                    case 'delete_data_by_id':
+                        self._remote.delete_data_by_id(user_id, args)
+                    case 'apply_ops':
+                        self._remote.apply_ops(user_id, ops_from_list(args))
+            except ResponseError as ex:
+                # Write is kept until remote recovers, unless it can never succeed
+                if not is_rejected(ex):
+                    raise
+                logger.warning("Queued %s of user '%s' is rejected: %s", method, user_id, ex)
+            except RequestError:
+                raise
+            except Exception:  # noqa
+                # Failing entry is retried on next syncs, then dropped so it doesn't block the queue
+                logger.exception("Queued %s of user '%s' failed", method, user_id)
+                if attempts + 1 < self.max_attempts:
+                    self._query('UPDATE outbox SET attempts = attempts + 1 WHERE id = ?', (entry_id,))
+                    return
+
+            self._query('DELETE FROM outbox WHERE id = ?', (entry_id,))
+
+    def _pull(self) -> None:
+        # Whole users list is fetched only when it was read, not on each write or change notification
+        if self._users_stale:
+            self._users_stale = False
+            try:
+                self._pull_users()
+            except Exception:
+                self._users_stale = True
+                raise
+
+        with self._lock:
+            # Users with queued writes keep their local state until the writes are sent
+            pending = {user_id for user_id, in self._conn.execute('SELECT DISTINCT user_id FROM outbox')}
+            watched = [user_id for user_id in self._watched if user_id not in pending]
+
+        for user_id in watched:
+            data = self._remote.get_data_by_id(user_id)
+
+            with self._lock, self._conn:
+                self._conn.execute('BEGIN')
+                # User may be written locally while its items were fetched
+                if self._conn.execute('SELECT 1 FROM outbox WHERE user_id = ?', (user_id,)).fetchone():
+                    continue
+                cached = {
+                    desc: (time, price) for desc, time, price in
+                    self._conn.execute('SELECT description, time, price FROM items WHERE user_id = ?', (user_id,))
+                }
+                if cached == data.to_dict():
+                    continue
+
+                self._conn.execute('DELETE FROM items WHERE user_id = ?', (user_id,))
+                self._set_items(self._conn, user_id, data)
+                listeners = list(self._watched[user_id])
+
+            for on_change in listeners:
+                on_change(None)
+
+    def _pull_users(self) -> None:
+        users = []
+        after = None
+        while page := self._remote.iter_users_after(after, self.page_size):
+            users += page
+            after = page[-1]
+
+        with self._lock, self._conn:
+            self._conn.execute('BEGIN')
+            pending = {user_id for user_id, in self._conn.execute('SELECT DISTINCT user_id FROM outbox')}
+            self._conn.execute('DELETE FROM users WHERE user_id NOT IN (SELECT user_id FROM outbox)')
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO users (user_id) VALUES (?)', [(u,) for u in users if u not in pending]
+            )
+            self._conn.execute('DELETE FROM items WHERE user_id NOT IN (SELECT user_id FROM users)')
+
+    def _sync_loop(self) -> None:
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                synced = self.sync()
+            except Exception:  # noqa
+                # Loop must survive any failure, otherwise client stays offline for good
+                logger.exception("Sync failed")
+                synced = False
+
+            if synced:
+                failures = 0
+                self._wake.wait(self.sync_interval)
+            else:
+                # Local writes don't wake sync during backoff, so failing remote is not hammered
+                failures += 1
+                self._stop.wait(min(self.sync_interval, self.retry_delay * 2 ** (failures - 1)))
+            self._wake.clear()
+
+    def close(self) -> None:
+        """
+        Waits at most `close_timeout` seconds for running sync, queued writes are kept for the next start.
+        """
+        self._stop.set()
+        self._wake.set()
+        for unsubscribe in self._unsubscribes.values():
+            unsubscribe()
+        self._thread.join(self.close_timeout)
+        # Sync blocked on remote is left to daemon thread, connection it uses is closed on exit
+        if not self._thread.is_alive():
+            self._conn.close()
@@ -0,0 +1,156 @@
+import io
+import threading
+import collections
+import multiprocessing
+
+import typing as T  # noqa
+
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from database import AppDatabase, SingleFlight
+
+
+ChartKind = T.Literal['pie']
+ChartFormat = T.Literal['png', 'webp']
+MEDIA_TYPES = {'png': 'image/png', 'webp': 'image/webp'}
+OTHER_LABEL = 'Other'
+
+
+def fold_slices(
+    labels: T.List[str],
+    values: T.List[float],
+    min_fraction: float = 0.03,
+    max_slices: int = 12
+) -> T.Tuple[T.List[str], T.List[float]]:
+    """
+    Sorts slices by value and folds ones smaller than `min_fraction` of total
+    and ones over `max_slices` to single `OTHER_LABEL` slice. Not positive values are dropped.
+    """
+    slices = sorted(((label, value) for label, value in zip(labels, values) if value > 0), key=lambda s: -s[1])
+    total = sum(value for _, value in slices)
+
+    kept = [s for s in slices if s[1] >= min_fraction * total]
+    if len(kept) < len(slices) or len(kept) > max_slices:
+        kept = kept[:max_slices - 1]
+        kept.append((OTHER_LABEL, total - sum(value for _, value in kept)))
+    return [label for label, _ in kept], [value for _, value in kept]
+
+
+def render_pie(
+    labels: T.List[str],
+    values: T.List[float],
+    width: int,
+    height: int,
+    dpi: int,
+    image_format: ChartFormat
+) -> bytes:
+    # Figure is drawn by Agg canvas without pyplot, so no GUI backend is loaded
+    figure = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot()
+    # User without items gets blank image
+    if values:
+        ax.pie(values, labels=labels, autopct='%1.0f%%', textprops={'fontsize': 8})
+    ax.set_aspect('equal')
+    ax.set_axis_off()
+    figure.tight_layout()
+
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+RENDERERS: T.Dict[str, T.Callable[..., bytes]] = {
+    'pie': render_pie
+}
+
+
+class ChartRenderer:
+    """
+    Renders charts of user items in process pool and keeps last `cache_size` images with user data epoch and version
+    they were rendered from, so chart of unchanged user is returned after `changes_since` version check only.
+    Charts of backends without versions (version 0) are rendered on each call.
+    """
+    cache_size: int = 100
+    min_fraction: float = 0.03
+    max_slices: int = 12
+    width: int = 480
+    height: int = 480
+    dpi: int = 96
+
+    workers: int | None
+
+    _pool: ProcessPoolExecutor | None = None
+    # (user_id, kind, format) -> (epoch, version, image), in order of use
+    _cache: collections.OrderedDict
+    _lock: threading.Lock
+    _renders: SingleFlight
+
+    def __init__(self, workers: int | None = None):
+        self.workers = workers
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._renders = SingleFlight()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # Pool is created in running server, forked workers would inherit locks held by its threads
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def render(
+        self,
+        database: AppDatabase,
+        user_id: str,
+        kind: ChartKind = 'pie',
+        image_format: ChartFormat = 'png'
+    ) -> bytes:
+        if kind not in RENDERERS:
+            raise ValueError(f"Unknown chart kind '{kind}', must be one of {tuple(RENDERERS)}")
+        if image_format not in MEDIA_TYPES:
+            raise ValueError(f"Unknown image format '{image_format}', must be one of {tuple(MEDIA_TYPES)}")
+
+        key = (user_id, kind, image_format)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+
+        epoch, version, image = (None, 0, None) if cached is None else cached
+        changes = database.changes_since(user_id, version, epoch)
+        if image is not None and not changes.snapshot and (changes.epoch, changes.version) == (epoch, version):
+            return image
+
+        def render() -> bytes:
+            data = changes.items if changes.snapshot else database.get_data_by_id(user_id)
+            labels, values = fold_slices(
+                [item.description for item in data.items],
+                [item.price for item in data.items],
+                self.min_fraction,
+                self.max_slices
+            )
+            return self._get_pool().submit(
+                RENDERERS[kind], labels, values, self.width, self.height, self.dpi, image_format
+            ).result()
+
+        if changes.epoch is None or changes.version <= 0:
+            return render()
+
+        # Concurrent requests of the same version share one render
+        image = self._renders.do((*key, changes.epoch, changes.version), render)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is None or cached[0] != changes.epoch or cached[1] < changes.version:
+                self._cache[key] = (changes.epoch, changes.version, image)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return image
+
+    def close(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
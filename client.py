@@ -1,3 +1,5 @@
+import os
+import math
 import regex as re
 
 
@@ -8,25 +10,31 @@ matplotlib.use("module://kivy_garden.matplotlib.backend_kivy")
 from kivy_garden.matplotlib.backend_kivyagg import FigureCanvasKivy
 
 from kivymd.uix.datatables.datatables import MDDataTable, CellRow  # noqa
-from kivymd.uix.button import MDFillRoundFlatButton, MDIconButton
+from kivymd.uix.button import MDFillRoundFlatButton, MDIconButton, MDFlatButton
 from kivymd.uix.anchorlayout import MDAnchorLayout
 from kivymd.uix.list import OneLineAvatarListItem, MDList
 from kivymd.uix.textfield import MDTextField
+from kivymd.uix.label import MDLabel
 from kivymd.uix.boxlayout import MDBoxLayout
 from kivymd.uix.dialog import MDDialog
 from kivymd.app import MDApp
 
-from kivy.properties import OptionProperty, ObjectProperty
+from kivy.properties import OptionProperty, ObjectProperty, StringProperty, NumericProperty
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
 from kivy.core.window import Window
+from kivy.clock import Clock
 from kivy.lang import Builder
 from kivy.metrics import dp
 
-from database import UserItems, Item, Database, DATETIME_FORMAT
+from database import UserItems, Item, Database, WebDatabase, DATETIME_FORMAT
+from cache import CachedDatabase
 
 import typing as T  # noqa
 
 if T.TYPE_CHECKING:
-    from database import AppDatabase
+    from database import AppDatabase, Operation, SortKey
     from kivy.uix.widget import Widget
     from kivymd.uix.widget import MDWidget
     WidgetT = T.Union[MDWidget, Widget, T.Type[MDWidget], T.Type[Widget]]
@@ -54,7 +62,9 @@ MDBoxLayout:
     'data_edit_font_size': 28,
     'buttons_font_size': 22,
     'columns_sizes': [36, 56, 36, 10],
-    'plot_font_size': 14
+    'plot_font_size': 14,
+    # MDDataTable is slow with hundreds of rows on Android
+    'table': 'recycle_view'
 }
 
 DESKTOP = {
@@ -78,7 +88,9 @@ MDBoxLayout:
     'data_edit_font_size': 18,
     'buttons_font_size': 16,
     'columns_sizes': [16, 28, 14, 8],
-    'plot_font_size': 14
+    'plot_font_size': 14,
+    # one of [ data_table, recycle_view ]
+    'table': 'data_table'
 }
 
 CONFIG: dict
@@ -157,9 +169,9 @@ class MDTextFieldWithValidation(MDTextField):
 
 
 class Plot(FigureCanvasKivy):
-    datatable: MDDataTable
+    datatable: T.Union['Table', 'RecycleTable']
 
-    def __init__(self, datatable_instance: MDDataTable, **kwargs):
+    def __init__(self, datatable_instance: T.Union['Table', 'RecycleTable'], **kwargs):
         fig, ax = plt.subplots()
         fig.figure.tight_layout()
         ax.pie([])
@@ -167,11 +179,12 @@ class Plot(FigureCanvasKivy):
         self.datatable = datatable_instance
 
     def redraw(self, sender: 'WidgetT'):
+        # Table shows only one page, so plot is drawn over all user items
         desc = []
         price = []
-        for row in self.datatable.row_data:
-            desc.append(row[0])
-            price.append(float(row[2]))
+        for item in self.datatable.database_instance.get_data_by_id(self.datatable.user_id).items:
+            desc.append(item.description)
+            price.append(item.price)
 
         self.figure.clear()
         _, labels = self.figure.gca().pie(x=price, labels=desc)
@@ -313,7 +326,7 @@ class UserSelectDialog(MDDialog):
 class Controls(MDBoxLayout):
     def __init__(
         self,
-        datatable_instance: 'Table',
+        datatable_instance: T.Union['Table', 'RecycleTable'],
         database_instance: 'AppDatabase',
         *args,
         **kwargs
@@ -425,7 +438,7 @@ class Controls(MDBoxLayout):
             description=self.desc.text,
             price=float(self.price.text)
         )
-        self.database_instance.add_data_by_id(self.user_id, UserItems(data))
+        self.database_instance.upsert_data_by_id(self.user_id, UserItems(data))
         self.datatable_instance.update()
 
         self.desc.text = ""
@@ -433,15 +446,31 @@ class Controls(MDBoxLayout):
 
 
 class Table(MDDataTable):
+    """
+    Shows one page of user items, items are sorted and paginated on database side.
+    """
     on_row_delete: T.Callable[[str, float], None] = ObjectProperty(None)
     on_row_data_press: T.Callable[[str, float], None] = ObjectProperty(None)
+    on_page_change: T.Callable[[int, int], None] = ObjectProperty(None)
+
+    page: int = 0
+    pages: int = 1
+    page_size: int
+    sort_key: 'SortKey' = 'time'
+    sort_desc: bool = False
+
+    _unsubscribe: T.Callable[[], None] | None = None
 
     def __init__(
         self,
         database_instance: 'AppDatabase',
+        page_size: int = 10,
         **kwargs
     ):
         self.database_instance = database_instance
+        self.page_size = page_size
+        # MDDataTable sort buttons start from descending order
+        self._next_sort_desc = {'time': True, 'price': True}
         columns_size = _columns_size()
 
         super().__init__(
@@ -451,31 +480,94 @@ class Table(MDDataTable):
                 ("Price", columns_size[2], self.sort_price),
                 ("", columns_size[3])
             ],
-            use_pagination=True,
+            rows_num=page_size,
+            use_pagination=False,
             **kwargs
         )
 
     def set_user(self, user_id: str):
         self.user_id = user_id
+        self.page = 0
+
+        # Only web and cached databases stream changes, rows will be patched on each change of user data
+        if self._unsubscribe is not None:
+            self._unsubscribe()
+            self._unsubscribe = None
+        if isinstance(self.database_instance, (WebDatabase, CachedDatabase)):
+            self._unsubscribe = self.database_instance.subscribe(user_id, self.on_change)
+
+    def _fetch_page(self) -> T.List[tuple]:
+        data, total = self.database_instance.get_items_page(
+            self.user_id,
+            self.page,
+            self.page_size,
+            self.sort_key,
+            self.sort_desc
+        )
+        self.pages = max(1, math.ceil(total / self.page_size))
+
+        if self.on_page_change is not None:
+            self.on_page_change(self.page, self.pages)
+        return [self._row(item) for item in data.items]
 
     def update(self):
-        data = self.database_instance.get_data_by_id(self.user_id)
-
-        self.row_data = [
-            (
-                item.description,
-                item.time.strftime(DATETIME_FORMAT),
-                item.price,
-                ("delete", [0.1, 0.1, 0.1, 1], "",)
-            )
-            for item in data.items
-        ]
+        self.row_data = self._fetch_page()
+
+        # Page may disappear after deletion of its last items
+        if self.page >= self.pages:
+            self.page = self.pages - 1
+            self.row_data = self._fetch_page()
+
+    def set_page(self, page: int):
+        self.page = min(max(page, 0), self.pages - 1)
+        self.update()
+
+    def on_change(self, ops: T.List['Operation'] | None):
+        # Called from subscriber thread, widgets must be changed in main thread
+        Clock.schedule_once(lambda dt: self._apply_changes(ops))
+
+    def _apply_changes(self, ops: T.List['Operation'] | None):
+        # Rows shown on page can be patched in place, other changes may move items between pages
+        rows = {row[0]: i for i, row in enumerate(self.row_data)}
+        if ops is None or any(
+            op != 'set' or any(item.description not in rows for item in arg.items)
+            for op, arg in ops
+        ):
+            self.update()
+            return
+
+        row_data = list(self.row_data)
+        for _, arg in ops:
+            for item in arg.items:
+                row_data[rows[item.description]] = self._row(item)
+        self.row_data = row_data
+
+    @staticmethod
+    def _row(item: Item) -> tuple:
+        return (
+            item.description,
+            item.time.strftime(DATETIME_FORMAT),
+            item.price,
+            ("delete", [0.1, 0.1, 0.1, 1], "",)
+        )
+
+    def _sort(self, sort_key: 'SortKey') -> T.Tuple[T.List[int], T.List[tuple]]:
+        self.sort_key = sort_key
+        self.sort_desc = self._next_sort_desc[sort_key]
+        self._next_sort_desc[sort_key] = not self.sort_desc
+        self.page = 0
+
+        rows = self._fetch_page()
+        # MDDataTable reverses rows sorted in descending order itself
+        if self.sort_desc:
+            rows = rows[::-1]
+        return list(range(len(rows))), rows
 
     def sort_time(self, row: CellRow):  # noqa
-        return zip(*sorted(enumerate(row), key=lambda d: d[1][1]))
+        return self._sort('time')
 
     def sort_price(self, row: CellRow):  # noqa
-        return zip(*sorted(enumerate(row), key=lambda d: d[1][2]))
+        return self._sort('price')
 
     def on_row_press(self, instance_cell_row: CellRow):
         row_data = self.row_data[int(instance_cell_row.index / len(self.column_data))]
@@ -486,6 +578,182 @@ class Table(MDDataTable):
             self.on_row_data_press(row_data[0], float(row_data[2])) # noqa
 
 
+class TablePager(MDBoxLayout):
+    def __init__(self, datatable_instance: Table, **kwargs):
+        self.datatable_instance = datatable_instance
+
+        super().__init__(orientation='horizontal', size_hint_y=None, height=dp(48), **kwargs)
+
+        self.prev = MDIconButton(icon="chevron-left", on_press=self.on_prev_press, disabled=True)
+        self.label = MDLabel(text="1 / 1", halign='center')
+        self.next = MDIconButton(icon="chevron-right", on_press=self.on_next_press, disabled=True)
+
+        self.add_widget(self.prev)
+        self.add_widget(self.label)
+        self.add_widget(self.next)
+
+        self.datatable_instance.on_page_change = self.on_page_change
+
+    def on_page_change(self, page: int, pages: int):
+        self.label.text = f"{page + 1} / {pages}"
+        self.prev.disabled = page == 0
+        self.next.disabled = page >= pages - 1
+
+    def on_prev_press(self, sender: 'WidgetT'):
+        self.datatable_instance.set_page(self.datatable_instance.page - 1)
+
+    def on_next_press(self, sender: 'WidgetT'):
+        self.datatable_instance.set_page(self.datatable_instance.page + 1)
+
+
+class ItemRow(RecycleDataViewBehavior, MDBoxLayout):
+    """
+    Row view of `RecycleTable`, views are reused for different items while scrolling.
+    """
+    description: str = StringProperty("")
+    time: str = StringProperty("")
+    price: float = NumericProperty(0.0)
+    table: 'RecycleTable' = ObjectProperty(None)
+
+    def __init__(self, **kwargs):
+        super().__init__(orientation='horizontal', **kwargs)
+        columns_size = _columns_size()
+
+        self.description_label = MDLabel(size_hint_x=None, width=columns_size[0])
+        self.time_label = MDLabel(size_hint_x=None, width=columns_size[1])
+        self.price_label = MDLabel(size_hint_x=None, width=columns_size[2])
+        self.delete = MDIconButton(icon="delete", size_hint_x=None, width=columns_size[3], on_press=self.on_delete_press)
+
+        self.add_widget(self.description_label)
+        self.add_widget(self.time_label)
+        self.add_widget(self.price_label)
+        self.add_widget(self.delete)
+
+    def on_description(self, instance: 'ItemRow', value: str):
+        self.description_label.text = value
+
+    def on_time(self, instance: 'ItemRow', value: str):
+        self.time_label.text = value
+
+    def on_price(self, instance: 'ItemRow', value: float):
+        self.price_label.text = f"{value:.2f}"
+
+    def on_delete_press(self, sender: 'WidgetT'):
+        self.table.on_row_delete(self.description)
+
+    def on_touch_down(self, touch) -> bool:
+        if self.collide_point(*touch.pos) and not self.delete.collide_point(*touch.pos):
+            self.table.on_row_data_press(self.description, self.price)
+            return True
+        return super().on_touch_down(touch)
+
+
+class RecycleTable(MDBoxLayout):
+    """
+    Alternative to `Table` based on RecycleView, which keeps only visible rows widgets.
+    All user items are loaded and sorted on the data model.
+    """
+    on_row_delete: T.Callable[[str], None] = ObjectProperty(None)
+    on_row_data_press: T.Callable[[str, float], None] = ObjectProperty(None)
+
+    sort_key: 'SortKey' = 'time'
+    sort_desc: bool = False
+
+    _items: T.List[Item]
+    _unsubscribe: T.Callable[[], None] | None = None
+
+    def __init__(
+        self,
+        database_instance: 'AppDatabase',
+        **kwargs
+    ):
+        self.database_instance = database_instance
+        self._items = []
+        columns_size = _columns_size()
+
+        super().__init__(orientation='vertical', **kwargs)
+
+        self.header = MDBoxLayout(orientation='horizontal', size_hint_y=None, height=dp(48))
+        self.header.add_widget(MDLabel(text="Description", size_hint_x=None, width=columns_size[0]))
+        self.header.add_widget(MDFlatButton(
+            text="Time",
+            size_hint_x=None,
+            width=columns_size[1],
+            on_press=lambda sender: self.sort('time')
+        ))
+        self.header.add_widget(MDFlatButton(
+            text="Price",
+            size_hint_x=None,
+            width=columns_size[2],
+            on_press=lambda sender: self.sort('price')
+        ))
+
+        self.rows = RecycleBoxLayout(
+            orientation='vertical',
+            default_size=(None, dp(48)),
+            default_size_hint=(1, None),
+            size_hint_y=None
+        )
+        self.rows.bind(minimum_height=self.rows.setter('height'))
+        self.view = RecycleView()
+        self.view.viewclass = ItemRow
+        self.view.add_widget(self.rows)
+
+        self.add_widget(self.header)
+        self.add_widget(self.view)
+
+    def set_user(self, user_id: str):
+        self.user_id = user_id
+
+        # Only web and cached databases stream changes, rows will be patched on each change of user data
+        if self._unsubscribe is not None:
+            self._unsubscribe()
+            self._unsubscribe = None
+        if isinstance(self.database_instance, (WebDatabase, CachedDatabase)):
+            self._unsubscribe = self.database_instance.subscribe(user_id, self.on_change)
+
+    def update(self):
+        self._items = self.database_instance.get_data_by_id(self.user_id).items
+        self._refresh()
+
+    def sort(self, sort_key: 'SortKey'):
+        self.sort_desc = not self.sort_desc if sort_key == self.sort_key else False
+        self.sort_key = sort_key
+        self._refresh()
+
+    def _refresh(self):
+        self._items.sort(key=lambda item: getattr(item, self.sort_key), reverse=self.sort_desc)
+        self.view.data = [
+            {
+                'description': item.description,
+                'time': item.time.strftime(DATETIME_FORMAT),
+                'price': item.price,
+                'table': self
+            }
+            for item in self._items
+        ]
+
+    def on_change(self, ops: T.List['Operation'] | None):
+        # Called from subscriber thread, widgets must be changed in main thread
+        Clock.schedule_once(lambda dt: self._apply_changes(ops))
+
+    def _apply_changes(self, ops: T.List['Operation'] | None):
+        if ops is None:
+            self.update()
+            return
+
+        items = {item.description: item for item in self._items}
+        for op, arg in ops:
+            if op == 'set':
+                for item in arg.items:
+                    items[item.description] = item
+            elif op == 'unset':
+                for desc in arg:
+                    items.pop(desc, None)
+        self._items = list(items.values())
+        self._refresh()
+
+
 class Main(MDApp):
     user_select: UserSelectDialog
     database_instance: 'AppDatabase'
@@ -497,10 +765,21 @@ class Main(MDApp):
     def on_start(self):
         self.user_select.open()
 
+        # Used to measure startup time of built binary
+        if os.getenv('EXIT_ON_START'):
+            Clock.schedule_once(lambda dt: self.stop())
+
+    def on_stop(self):
+        if isinstance(self.database_instance, CachedDatabase):
+            self.database_instance.close()
+
     def build(self):
         root = Builder.load_string(CONFIG['ui'])
 
-        table = Table(database_instance=self.database_instance)
+        if CONFIG['table'] == 'recycle_view':
+            table = RecycleTable(database_instance=self.database_instance)
+        else:
+            table = Table(database_instance=self.database_instance)
         controls = Controls(
             datatable_instance=table,
             database_instance=self.database_instance,
@@ -517,7 +796,13 @@ class Main(MDApp):
             on_select=on_select
         )
 
-        root.ids.table.add_widget(table)
+        if isinstance(table, Table):
+            table_wrapper = MDBoxLayout(orientation='vertical')
+            table_wrapper.add_widget(table)
+            table_wrapper.add_widget(TablePager(table))
+            root.ids.table.add_widget(table_wrapper)
+        else:
+            root.ids.table.add_widget(table)
         root.ids.controls.add_widget(controls)
         return root
 
@@ -537,4 +822,9 @@ def run(dotenv_path: str = None, config: T.Literal['mobile', 'desktop'] = 'mobil
         const.load_dotenv(dotenv_path)
 
     database = Database()
-    Main(database_instance=database).run()
+    app = Main(database_instance=database)
+
+    # Web database is served from local cache, so the first paint doesn't wait for the network
+    if isinstance(database, WebDatabase):
+        app.database_instance = CachedDatabase(database, os.path.join(app.user_data_dir, 'cache.sqlite3'))
+    app.run()
@@ -16,6 +16,33 @@ MONGO_COLLECTION_NAME: EnvVar = None
 FIREBASE_COLLECTION_NAME: EnvVar = None
 FIREBASE_CREDENTIALS_PATH: EnvVar = None
 
+# for SHARDED_MONGO_DB, comma-separated list of host:port
+DATABASE_SHARDS: EnvVar = None
+
+# optional replica set read options for MONGO_DB and SHARDED_MONGO_DB, value for all read classes
+# or per read class, for example 'iter_all_users=secondary,get_data_by_id=secondaryPreferred'
+MONGO_READ_PREFERENCE: EnvVar = None
+MONGO_READ_CONCERN: EnvVar = None
+MONGO_MAX_STALENESS: EnvVar = None
+MONGO_READ_YOUR_WRITES: EnvVar = None
+
+# optional threshold of logged slow Mongo commands in milliseconds
+MONGO_SLOW_COMMAND_MS: EnvVar = None
+# optional age in days after which item buckets are moved to archive collection
+MONGO_ARCHIVE_AFTER_DAYS: EnvVar = None
+# any non-empty value enables development checks, e.g. explain of Mongo queries
+DEV_MODE: EnvVar = None
+
+# optional server admission control vars, empty value disables limit
+ADMISSION_MAX_CONCURRENCY: EnvVar = None
+ADMISSION_MAX_QUEUE: EnvVar = None
+ADMISSION_QUEUE_TIMEOUT: EnvVar = None
+RATE_LIMIT_PER_USER: EnvVar = None
+RATE_LIMIT_BURST: EnvVar = None
+
+# optional file to which client and server append tracing spans
+TRACE_FILE: EnvVar = None
+
 _is_env_loaded = False
 
 
@@ -39,6 +66,20 @@ def load_dotenv(path: str):
     global MONGO_COLLECTION_NAME
     global FIREBASE_COLLECTION_NAME
     global FIREBASE_CREDENTIALS_PATH
+    global DATABASE_SHARDS
+    global MONGO_READ_PREFERENCE
+    global MONGO_READ_CONCERN
+    global MONGO_MAX_STALENESS
+    global MONGO_READ_YOUR_WRITES
+    global ADMISSION_MAX_CONCURRENCY
+    global ADMISSION_MAX_QUEUE
+    global ADMISSION_QUEUE_TIMEOUT
+    global RATE_LIMIT_PER_USER
+    global RATE_LIMIT_BURST
+    global TRACE_FILE
+    global MONGO_SLOW_COMMAND_MS
+    global MONGO_ARCHIVE_AFTER_DAYS
+    global DEV_MODE
 
     MONGO_USER = os.environ['MONGO_USER']
     MONGO_PASS = os.environ['MONGO_PASS']
@@ -51,6 +92,20 @@ def load_dotenv(path: str):
     MONGO_COLLECTION_NAME = os.environ['MONGO_COLLECTION_NAME']
     FIREBASE_COLLECTION_NAME = os.environ['FIREBASE_COLLECTION_NAME']
     FIREBASE_CREDENTIALS_PATH = os.environ['FIREBASE_CREDENTIALS_PATH']
+    DATABASE_SHARDS = os.getenv('DATABASE_SHARDS') or None
+    MONGO_READ_PREFERENCE = os.getenv('MONGO_READ_PREFERENCE') or None
+    MONGO_READ_CONCERN = os.getenv('MONGO_READ_CONCERN') or None
+    MONGO_MAX_STALENESS = os.getenv('MONGO_MAX_STALENESS') or None
+    MONGO_READ_YOUR_WRITES = os.getenv('MONGO_READ_YOUR_WRITES') or None
+    ADMISSION_MAX_CONCURRENCY = os.getenv('ADMISSION_MAX_CONCURRENCY') or None
+    ADMISSION_MAX_QUEUE = os.getenv('ADMISSION_MAX_QUEUE') or None
+    ADMISSION_QUEUE_TIMEOUT = os.getenv('ADMISSION_QUEUE_TIMEOUT') or None
+    RATE_LIMIT_PER_USER = os.getenv('RATE_LIMIT_PER_USER') or None
+    RATE_LIMIT_BURST = os.getenv('RATE_LIMIT_BURST') or None
+    TRACE_FILE = os.getenv('TRACE_FILE') or None
+    MONGO_SLOW_COMMAND_MS = os.getenv('MONGO_SLOW_COMMAND_MS') or None
+    MONGO_ARCHIVE_AFTER_DAYS = os.getenv('MONGO_ARCHIVE_AFTER_DAYS') or None
+    DEV_MODE = os.getenv('DEV_MODE') or None
 
 
 def load_vars(
@@ -64,7 +119,21 @@ def load_vars(
     mongo_database_name: EnvVar = None,
     mongo_collection_name: EnvVar = None,
     firebase_collection_name: EnvVar = None,
-    firebase_credentials_name: EnvVar = None
+    firebase_credentials_name: EnvVar = None,
+    database_shards: EnvVar = None,
+    mongo_read_preference: EnvVar = None,
+    mongo_read_concern: EnvVar = None,
+    mongo_max_staleness: EnvVar = None,
+    mongo_read_your_writes: EnvVar = None,
+    admission_max_concurrency: EnvVar = None,
+    admission_max_queue: EnvVar = None,
+    admission_queue_timeout: EnvVar = None,
+    rate_limit_per_user: EnvVar = None,
+    rate_limit_burst: EnvVar = None,
+    trace_file: EnvVar = None,
+    mongo_slow_command_ms: EnvVar = None,
+    mongo_archive_after_days: EnvVar = None,
+    dev_mode: EnvVar = None
 ):
     global _is_env_loaded
 
@@ -83,6 +152,20 @@ def load_vars(
     global MONGO_COLLECTION_NAME
     global FIREBASE_COLLECTION_NAME
     global FIREBASE_CREDENTIALS_PATH
+    global DATABASE_SHARDS
+    global MONGO_READ_PREFERENCE
+    global MONGO_READ_CONCERN
+    global MONGO_MAX_STALENESS
+    global MONGO_READ_YOUR_WRITES
+    global ADMISSION_MAX_CONCURRENCY
+    global ADMISSION_MAX_QUEUE
+    global ADMISSION_QUEUE_TIMEOUT
+    global RATE_LIMIT_PER_USER
+    global RATE_LIMIT_BURST
+    global TRACE_FILE
+    global MONGO_SLOW_COMMAND_MS
+    global MONGO_ARCHIVE_AFTER_DAYS
+    global DEV_MODE
 
     MONGO_USER = mongo_user
     MONGO_PASS = mongo_pass
@@ -95,3 +178,17 @@ def load_vars(
     MONGO_COLLECTION_NAME = mongo_collection_name
     FIREBASE_COLLECTION_NAME = firebase_collection_name
     FIREBASE_CREDENTIALS_PATH = firebase_credentials_name
+    DATABASE_SHARDS = database_shards
+    MONGO_READ_PREFERENCE = mongo_read_preference
+    MONGO_READ_CONCERN = mongo_read_concern
+    MONGO_MAX_STALENESS = mongo_max_staleness
+    MONGO_READ_YOUR_WRITES = mongo_read_your_writes
+    ADMISSION_MAX_CONCURRENCY = admission_max_concurrency
+    ADMISSION_MAX_QUEUE = admission_max_queue
+    ADMISSION_QUEUE_TIMEOUT = admission_queue_timeout
+    RATE_LIMIT_PER_USER = rate_limit_per_user
+    RATE_LIMIT_BURST = rate_limit_burst
+    TRACE_FILE = trace_file
+    MONGO_SLOW_COMMAND_MS = mongo_slow_command_ms
+    MONGO_ARCHIVE_AFTER_DAYS = mongo_archive_after_days
+    DEV_MODE = dev_mode
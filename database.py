@@ -1,20 +1,89 @@
 import abc
+import json
+import time
+import queue
+import logging
+import heapq
+import bisect
+import asyncio
+import contextvars
+import hashlib
+import threading
+import itertools
+import collections
 
 import typing as T  # noqa
 
 from bson import ObjectId
-from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pydantic import BaseModel
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, UpdateOne, UpdateMany, DeleteMany, monitoring
+from pymongo.errors import DuplicateKeyError
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
 from urllib.parse import quote_plus
-from httpx import Client, RequestError
+from httpx import Client, RequestError, Response
+
+import tracing
 
 if T.TYPE_CHECKING:
     from google.cloud.firestore import Client
     from pymongo.collection import Collection
 
+logger = logging.getLogger(__name__)
+
 Value = T.Union[str, int, float, datetime]
 DATETIME_FORMAT = '%d-%m-%Y %H:%M'
+EPOCH = datetime(1970, 1, 1)
+# Prices are stored as integer number of minor units (cents)
+PRICE_SCALE = 100
+# Version of stored items encoding, buckets without `schema` field store (DATETIME_FORMAT time, float price)
+SCHEMA_VERSION = 2
+# Fields of user document which are not user items
+RESERVED_FIELDS = ('_id', 'user_id', 'version', 'changes')
+# Name of index of users collection on `user_id`
+USER_ID_INDEX = 'user_id_1'
+# Suffix of Mongo collection with user items buckets
+BUCKETS_SUFFIX = '_buckets'
+# Suffix of Mongo collection with archived buckets of old months
+ARCHIVE_SUFFIX = '_archive'
+SortKey = T.Literal['time', 'price', 'description']
+SORT_KEYS = ('time', 'price', 'description')
+# Classes of read operations, which can be configured with different read preferences
+READ_CLASSES = ('get_data_by_id', 'iter_all_users', 'aggregate')
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest
+}
+
+
+def parse_per_read_class(value: str | None) -> T.Dict[str, str]:
+    """
+    Parses config value like 'secondaryPreferred' (for all read classes)
+    or 'iter_all_users=secondary,get_data_by_id=nearest' (per read class).
+    """
+    out = {}
+    if not value:
+        return out
+
+    for entry in value.split(','):
+        read_class, sep, class_value = entry.strip().rpartition('=')
+        if not sep:
+            out.update({c: class_value for c in READ_CLASSES})
+        elif read_class in READ_CLASSES:
+            out[read_class] = class_value
+        else:
+            raise ValueError(f"Unknown read class '{read_class}', must be one of {READ_CLASSES}")
+    return out
+
+
+def check_sort_key(sort_key: str) -> None:
+    if sort_key not in SORT_KEYS:
+        raise ValueError(f"Unknown sort key '{sort_key}', must be one of {SORT_KEYS}")
 
 
 def format_datetime(time: datetime) -> str | None:
@@ -25,6 +94,10 @@ def format_datetime(time: datetime) -> str | None:
     return None
 
 
+def month_start(time: datetime) -> datetime:
+    return time.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
 def parse_datetime(time: str) -> datetime | None:
     if isinstance(time, datetime):
         return time
@@ -33,6 +106,28 @@ def parse_datetime(time: str) -> datetime | None:
     return None
 
 
+def encode_time(time: datetime) -> int:
+    """
+    Encodes time to minutes since epoch.
+    """
+    return int((time - EPOCH).total_seconds()) // 60
+
+
+def encode_price(price: float) -> int:
+    return round(price * PRICE_SCALE)
+
+
+def decode_item(value: T.Sequence[T.Any]) -> T.Tuple[datetime, float]:
+    """
+    Decodes (time, price) of item encoded with `encode_time` and `encode_price`,
+    or legacy ("dd-mm-YYYY HH:MM", price) one.
+    """
+    time, price = value[0], value[1]
+    if isinstance(time, str):
+        return parse_datetime(time), float(price)
+    return EPOCH + timedelta(minutes=time), price / PRICE_SCALE
+
+
 class Item(BaseModel):
     description: str
     time: datetime
@@ -57,21 +152,111 @@ class UserItems(BaseModel):
         super().__init__(items=items)
 
     @classmethod
-    def from_dict(cls, dict_data: T.Dict[str, T.Iterable[T.Union[datetime, float]]]) -> 'UserItems':
-        items = []
-        for description, time_price in dict_data.items():
-            items += [Item(
-                description=description,
-                time=parse_datetime(time_price[0]), # noqa
-                price=time_price[1] # noqa
-            )]
-        return cls(items=items)
-
-    def to_dict(self) -> T.Dict[str, T.Iterable[T.Union[datetime, float]]]:
-        out = {}
-        for item in self.items:
-            out[item.description] = (format_datetime(item.time), item.price)
-        return out
+    def from_dict(cls, dict_data: T.Dict[str, T.Sequence[T.Union[str, int, float]]]) -> 'UserItems':
+        with tracing.span('items.decode', items=len(dict_data)):
+            items = []
+            for description, value in dict_data.items():
+                time, price = decode_item(value)
+                items += [Item(description=description, time=time, price=price)]
+            return cls(items=items)
+
+    def to_dict(self) -> T.Dict[str, T.Tuple[int, int]]:
+        """
+        Encodes items as {description: (minutes since epoch, price in minor units)}.
+        """
+        with tracing.span('items.encode', items=len(self.items)):
+            out = {}
+            for item in self.items:
+                out[item.description] = (encode_time(item.time), encode_price(item.price))
+            return out
+
+
+class UserSummary(BaseModel):
+    count: int = 0
+    total: float = 0.0
+    min_price: float | None = None
+    max_price: float | None = None
+    updated: datetime | None = None
+
+    @classmethod
+    def from_dict(cls, dict_data: T.Dict[str, T.Any]) -> 'UserSummary':
+        return cls(**{**dict_data, 'updated': parse_datetime(dict_data.get('updated'))})
+
+    def to_dict(self) -> T.Dict[str, T.Any]:
+        return {
+            'count': self.count,
+            'total': self.total,
+            'min_price': self.min_price,
+            'max_price': self.max_price,
+            'updated': format_datetime(self.updated)
+        }
+
+
+class UserChanges(BaseModel):
+    """
+    Changes of user data since some version: current `items` with changed descriptions and `deleted` descriptions.
+    If `snapshot` is set, `items` are all user items, which replace data held by client.
+    Versions are comparable only within the same `epoch`, which changes when user is created again or moved.
+    """
+    epoch: str | None = None
+    version: int = 0
+    snapshot: bool = False
+    items: UserItems = UserItems()
+    deleted: list[str] = []
+
+    @classmethod
+    def from_dict(cls, dict_data: T.Dict[str, T.Any]) -> 'UserChanges':
+        return cls(**{**dict_data, 'items': UserItems.from_dict(dict_data.get('items', {}))})
+
+    def to_dict(self) -> T.Dict[str, T.Any]:
+        return {
+            'epoch': self.epoch,
+            'version': self.version,
+            'snapshot': self.snapshot,
+            'items': self.items.to_dict(),
+            'deleted': self.deleted
+        }
+
+    def apply(self, data: T.Dict[str, T.Any]) -> T.Dict[str, T.Any]:
+        """
+        Applies changes to user items in `UserItems.to_dict` format, returns new items dict.
+        """
+        data = {} if self.snapshot else dict(data)
+        for desc in self.deleted:
+            data.pop(desc, None)
+        data.update(self.items.to_dict())
+        return data
+
+
+OperationType = T.Literal['set', 'unset']
+# ('set', UserItems) adds or replaces items, ('unset', [description, ...]) deletes items
+Operation = T.Tuple[OperationType, T.Union[UserItems, T.List[str]]]
+
+
+def ops_to_list(ops: T.Iterable[Operation]) -> T.List[T.Dict[str, T.Any]]:
+    out = []
+    for op, arg in ops:
+        match op:
+            case 'set':
+                out.append({'op': op, 'data': arg.to_dict()})
+            case 'unset':
+                out.append({'op': op, 'fields': list(arg)})
+            case _:
+                raise ValueError(f"Unknown operation '{op}'")
+    return out
+
+
+def ops_from_list(list_data: T.Iterable[T.Dict[str, T.Any]]) -> T.List[Operation]:
+    out = []
+    for op in list_data:
+        match op['op']:
+            case 'set':
+                out.append(('set', UserItems.from_dict(op['data'])))
+            case 'unset':
+                out.append(('unset', list(op['fields'])))
+            case _:
+                raise ValueError(f"Unknown operation '{op['op']}'")
+    return out
 
 
 class AppDatabase(abc.ABC):
@@ -84,13 +269,32 @@ class AppDatabase(abc.ABC):
         raise NotImplementedError()
 
     @abc.abstractmethod
-    def get_data_by_id(self, user_id: str) -> UserItems:
+    def get_data_by_id(
+        self,
+        user_id: str,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        limit: int | None = None
+    ) -> UserItems:
+        """
+        Returns user items filtered by time range [since, until] and price range [min_price, max_price].
+        If `limit` passed, only `limit` latest items will be returned.
+        """
         raise NotImplementedError()
 
     @abc.abstractmethod
     def add_data_by_id(self, user_id: str, data: UserItems) -> None:
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    def upsert_data_by_id(self, user_id: str, data: UserItems) -> None:
+        """
+        Adds data to user, user will be created if not exists.
+        """
+        raise NotImplementedError()
+
     @abc.abstractmethod
     def delete_data_by_id(self, user_id: str, fields: T.List[str]) -> None:
         raise NotImplementedError()
@@ -99,10 +303,299 @@ class AppDatabase(abc.ABC):
     def iter_all_users(self, pid: int, n: int) -> T.List[str]:
         raise NotImplementedError()
 
+    def iter_users_after(self, after: str | None, n: int) -> T.List[str]:
+        """
+        Returns up to `n` users following user `after` (or first users if `after` is None) in `user_id` order.
+        Backends should override it to seek by `user_id` instead of scanning pages.
+        """
+        users = []
+        for pid in itertools.count():
+            page = self.iter_all_users(pid, n)
+            users += [user_id for user_id in page if after is None or user_id > after]
+            if len(users) >= n or len(page) < n:
+                return users[:n]
+
+    def apply_ops(self, user_id: str, ops: T.List[Operation]) -> None:
+        """
+        Applies ordered list of set/unset operations to user data.
+        Backends should override it to apply all operations at once.
+        """
+        for op, arg in ops:
+            match op:
+                case 'set':
+                    self.add_data_by_id(user_id, arg)
+                case 'unset':
+                    self.delete_data_by_id(user_id, arg)
+                case _:
+                    raise ValueError(f"Unknown operation '{op}'")
+
+    def get_items_page(
+        self,
+        user_id: str,
+        page: int,
+        page_size: int,
+        sort_key: SortKey = 'time',
+        sort_desc: bool = False
+    ) -> T.Tuple[UserItems, int]:
+        """
+        Returns one page of user items sorted by `sort_key` and total number of user items.
+        Backends should override it to sort and paginate items on database side.
+        """
+        check_sort_key(sort_key)
+        items = self.get_data_by_id(user_id).items
+        items.sort(key=lambda item: getattr(item, sort_key), reverse=sort_desc)
+        return UserItems(items[page*page_size:(page+1)*page_size]), len(items)
+
+    def get_summary(self, user_id: str) -> UserSummary:
+        """
+        Returns summary of user items. Backends should override it to not read all user items.
+        """
+        prices = [item.price for item in self.get_data_by_id(user_id).items]
+        if not prices:
+            return UserSummary()
+        return UserSummary(count=len(prices), total=sum(prices), min_price=min(prices), max_price=max(prices))
+
+    def changes_since(self, user_id: str, version: int, epoch: str | None = None) -> UserChanges:
+        """
+        Returns changes of user data after `version` of `epoch`.
+        Backends without changes log return snapshot of all data.
+        """
+        return UserChanges(snapshot=True, items=self.get_data_by_id(user_id))
+
+    def export(self, batch_size: int = 100) -> T.Iterator[T.Tuple[str, UserItems]]:
+        """
+        Iterates over all users and their data in order of `iter_all_users`.
+        """
+        for pid in itertools.count():
+            users = self.iter_all_users(pid, batch_size)
+            yield from self.export_users(users)
+            if len(users) < batch_size:
+                break
+
+    def export_users(self, user_ids: T.List[str]) -> T.Iterator[T.Tuple[str, UserItems]]:
+        """
+        Iterates over given users and all their data, as `export` does.
+        Backends should override it to read users in batch.
+        """
+        for user_id in user_ids:
+            yield user_id, self.get_data_by_id(user_id)
+
+
+# Converts legacy bucket items to current encoding, so buckets never mix encodings
+_LEGACY_ITEMS = {'$arrayToObject': {'$map': {
+    'input': {'$objectToArray': {'$ifNull': ['$items', {}]}},
+    'in': {'k': '$$this.k', 'v': [
+        {'$toLong': {'$divide': [
+            {'$toLong': {'$dateFromString': {
+                'dateString': {'$arrayElemAt': ['$$this.v', 0]},
+                'format': DATETIME_FORMAT,
+                'timezone': 'UTC'
+            }}},
+            60 * 1000
+        ]}},
+        {'$toLong': {'$round': [{'$multiply': [{'$arrayElemAt': ['$$this.v', 1]}, PRICE_SCALE]}, 0]}}
+    ]}
+}}}
+# Update pipeline stage, which upgrades bucket to `SCHEMA_VERSION`, it is no-op for upgraded buckets
+BUCKET_UPGRADE_STAGE = {'$set': {
+    'items': {'$cond': [{'$eq': ['$schema', SCHEMA_VERSION]}, '$items', _LEGACY_ITEMS]},
+    'schema': SCHEMA_VERSION
+}}
+_BUCKET_PRICES = {'$map': {
+    'input': {'$objectToArray': {'$ifNull': ['$items', {}]}},
+    'in': {'$arrayElemAt': ['$$this.v', 1]}
+}}
+# Update pipeline stage, which recalculates bucket summary (in price minor units)
+# in the same atomic update as items change
+BUCKET_SUMMARY_STAGE = {'$set': {
+    'count': {'$size': _BUCKET_PRICES},
+    'sum': {'$sum': _BUCKET_PRICES},
+    'min': {'$min': _BUCKET_PRICES},
+    'max': {'$max': _BUCKET_PRICES},
+    'updated': '$$NOW'
+}}
+_IS_CURRENT_SCHEMA = {'$eq': ['$schema', SCHEMA_VERSION]}
+# Aggregation stages which convert legacy buckets on read, so reads are correct before `migrate_encoding`:
+# items to current encoding and summary (in price major units or missing) to the one of converted items
+BUCKET_READ_STAGE = {'$set': {'items': {'$cond': [_IS_CURRENT_SCHEMA, '$items', _LEGACY_ITEMS]}}}
+BUCKET_READ_SUMMARY_STAGE = {'$set': {
+    'count': {'$cond': [_IS_CURRENT_SCHEMA, '$count', {'$size': _BUCKET_PRICES}]},
+    'sum': {'$cond': [_IS_CURRENT_SCHEMA, '$sum', {'$sum': _BUCKET_PRICES}]},
+    'min': {'$cond': [_IS_CURRENT_SCHEMA, '$min', {'$min': _BUCKET_PRICES}]},
+    'max': {'$cond': [_IS_CURRENT_SCHEMA, '$max', {'$max': _BUCKET_PRICES}]}
+}}
+
+
+# Command fields which hold queries, by command name
+QUERY_FIELDS = {
+    'find': ('filter', 'sort'),
+    'count': ('query',),
+    'aggregate': ('pipeline',),
+    'update': ('updates',),
+    'delete': ('deletes',),
+    'findAndModify': ('query', 'sort')
+}
+
+
+def query_shape(value: T.Any) -> T.Any:
+    """
+    Replaces values in query with '?', keeping field names and operators, so queries differing
+    only by values have the same shape.
+    """
+    if isinstance(value, dict):
+        # Item descriptions are field names of bucket items
+        return {'items.?' if k.startswith('items.') else k: query_shape(v) for k, v in value.items()}
+    if isinstance(value, list) and any(isinstance(v, (dict, list)) for v in value):
+        return _unique_shapes(value)
+    return '?'
+
+
+def _unique_shapes(values: T.Iterable[T.Any]) -> T.List[T.Any]:
+    shapes = []
+    for value in values:
+        shape = query_shape(value)
+        if shape not in shapes:
+            shapes.append(shape)
+    return shapes
+
+
+def command_shape(command: T.Mapping[str, T.Any]) -> str:
+    name = next(iter(command))
+    shape = {}
+    for field in QUERY_FIELDS.get(name, ()):
+        if field in ('updates', 'deletes'):
+            # Only queries of write statements
+            shape[field] = _unique_shapes(statement['q'] for statement in command.get(field, ()))
+        elif field in command:
+            shape[field] = query_shape(command[field])
+    return f"{name} {command[name]} {json.dumps(shape, default=str)}"
+
+
+class SlowCommandLogger(monitoring.CommandListener):
+    """
+    Logs warning with shape and duration of each command slower than `threshold_ms`.
+    """
+    threshold_ms: float
+
+    _commands: T.Dict[int, T.Mapping[str, T.Any]]
+
+    def __init__(self, threshold_ms: float):
+        self.threshold_ms = threshold_ms
+        self._commands = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        # Command shape is built only for slow commands
+        self._commands[event.request_id] = event.command
+
+    def _finish(self, event: T.Union[monitoring.CommandSucceededEvent, monitoring.CommandFailedEvent]) -> None:
+        command = self._commands.pop(event.request_id, None)
+        duration_ms = event.duration_micros / 1000
+        if command is not None and duration_ms >= self.threshold_ms:
+            logger.warning("Slow Mongo command %.1f ms: %s", duration_ms, command_shape(command))
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finish(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finish(event)
+
+
+class IndexChecker(monitoring.CommandListener):
+    """
+    Explains each new query shape in background thread and logs warning if its plan has collection scan.
+    Explain doubles load of the database, so checker is meant for development only.
+    """
+    client: MongoClient | None = None
+
+    _checked: T.Set[str]
+    _queue: queue.Queue
+
+    def __init__(self):
+        self._checked = set()
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if event.command_name not in QUERY_FIELDS:
+            return
+
+        shape = command_shape(event.command)
+        if shape not in self._checked:
+            self._checked.add(shape)
+            self._queue.put((event.database_name, shape, event.command))
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        pass
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        pass
+
+    @staticmethod
+    def _explained_commands(command: T.Mapping[str, T.Any]) -> T.Iterator[dict]:
+        # Session, cluster time and write options are not allowed in explained command
+        name = next(iter(command))
+        command = {
+            k: v for k, v in command.items()
+            if not k.startswith('$') and k not in ('lsid', 'txnNumber', 'writeConcern', 'readConcern', 'cursor')
+        }
+        if name == 'aggregate':
+            command['cursor'] = {}
+
+        # Update and delete are explained by one statement
+        if name in ('update', 'delete'):
+            statements = command.pop(name + 's')
+            for statement in statements:
+                yield {**command, name + 's': [statement]}
+        else:
+            yield command
+
+    @staticmethod
+    def _has_collscan(plan: T.Any) -> bool:
+        if isinstance(plan, dict):
+            return plan.get('stage') == 'COLLSCAN' or any(IndexChecker._has_collscan(v) for v in plan.values())
+        if isinstance(plan, list):
+            return any(IndexChecker._has_collscan(v) for v in plan)
+        return False
+
+    def _run(self) -> None:
+        while True:
+            database, shape, command = self._queue.get()
+            if self.client is None:
+                continue
+
+            try:
+                for explained in self._explained_commands(command):
+                    plan = self.client[database].command({'explain': explained, 'verbosity': 'queryPlanner'})
+                    if self._has_collscan(plan.get('queryPlanner', plan)):
+                        logger.warning("Mongo query does collection scan: %s", shape)
+                        break
+            except Exception as ex:  # noqa
+                logger.warning("Failed to explain Mongo query %s: %s", shape, ex)
+
 
 class MongoDatabase(AppDatabase):
+    """
+    Users are stored in `collection`, their items are stored in `<collection>_buckets`,
+    one bucket document per user per month: {user_id, month, schema, items: {description: (time, price)}, <summary>}.
+    Items are encoded by `UserItems.to_dict`, legacy buckets are upgraded on write or by `migrate_encoding`.
+    Bucket summary (count, sum, min, max, updated) is maintained on each write of bucket items.
+    User document holds monotonic `version` of user data and log of last `max_changes` versions
+    with their changed descriptions: {user_id, version, changes: [{v, d: [description, ...]}]},
+    its `_id` is the epoch of versions, as they start again when user is created again or moved to other shard.
+    Buckets of months older than `archive_after` are moved by `archive` to `<collection>_archive`
+    of the same layout, reads consult archive only if their time range reaches archived months.
+    """
+    max_tracked_writes: int = 10000
+    max_changes: int = 100
+
+    read_your_writes: float | None
+
     _col: 'Collection'
+    _buckets: 'Collection'
+    _archive: 'Collection'
+    _read_cols: T.Dict[str, T.Tuple['Collection', 'Collection', 'Collection']]
     _client: MongoClient
+    _writes: T.Dict[str, float]
 
     def __init__(
             self,
@@ -112,137 +605,1322 @@ class MongoDatabase(AppDatabase):
             port: int = 27017,
             user: str = None,
             password: str = None,
+            read_preference: T.Dict[str, str] | None = None,
+            read_concern: T.Dict[str, str] | None = None,
+            max_staleness: T.Dict[str, str] | None = None,
+            read_your_writes: float | None = None,
+            slow_command_ms: float | None = None,
+            check_indexes: bool = False,
+            archive_after: timedelta | None = None
     ):
+        """
+        `read_preference`, `read_concern` and `max_staleness` are set per read class (see `READ_CLASSES`),
+        writes are always sent to primary. If `read_your_writes` passed, reads of user during
+        `read_your_writes` seconds after its write are sent to primary.
+        Commands slower than `slow_command_ms` are logged, `check_indexes` logs queries doing collection scans.
+        `archive_after` is the age of buckets moved to archive, it must be the same for all clients of collection.
+        Archive is read only by `get_data_by_id` with `since` before archive cutoff and by `export`,
+        other reads (unfiltered, paged, summary and changes) return only items which are not archived.
+        """
         if user and password:
             uri = "mongodb://%s:%s@%s" % (quote_plus(user), quote_plus(password), host)
         else:
-            uri = 'localhost'
+            uri = host or 'localhost'
+
+        listeners = []
+        if tracing.enabled():
+            listeners.append(tracing.CommandTracer())
+        if slow_command_ms is not None:
+            listeners.append(SlowCommandLogger(slow_command_ms))
+        if check_indexes:
+            index_checker = IndexChecker()
+            listeners.append(index_checker)
 
         self._client = MongoClient(
             host=uri,
-            port=port
+            port=port,
+            event_listeners=listeners or None
         )
+        if check_indexes:
+            index_checker.client = self._client
 
-        if collection not in self._client[database].list_collection_names():
-            self._client[database].create_collection(collection)
+        collections = self._client[database].list_collection_names()
+        for name in (collection, collection + BUCKETS_SUFFIX, collection + ARCHIVE_SUFFIX):
+            if name not in collections:
+                self._client[database].create_collection(name)
 
         self._col = self._client[database][collection]
-        self._col.create_index('user_id')
+        # Existing collection may hold duplicate users, its index is made unique by `dedupe_users` migration
+        index = self._col.index_information().get(USER_ID_INDEX)
+        if index is None:
+            unique = self._col.estimated_document_count() == 0
+            self._col.create_index('user_id', name=USER_ID_INDEX, unique=unique)
+        else:
+            unique = index.get('unique', False)
+        if not unique:
+            logger.warning("Index '%s' of '%s' is not unique, run `main.py --dedupe-users`", USER_ID_INDEX, collection)
+        self._buckets = self._client[database][collection + BUCKETS_SUFFIX]
+        self._buckets.create_index([('user_id', ASCENDING), ('month', ASCENDING)], unique=True)
+        self._archive = self._client[database][collection + ARCHIVE_SUFFIX]
+        self._archive.create_index([('user_id', ASCENDING), ('month', ASCENDING)], unique=True)
+
+        # Archive left by previous configuration is still consulted
+        self.archive_after = archive_after
+        self._has_archive = archive_after is not None or self._archive.estimated_document_count() > 0
+
+        self._read_cols = {}
+        for read_class in READ_CLASSES:
+            options = {}
+            if read_preference and read_class in read_preference:
+                preference = READ_PREFERENCES[read_preference[read_class]]
+                if max_staleness and read_class in max_staleness and preference is not Primary:
+                    options['read_preference'] = preference(max_staleness=int(max_staleness[read_class]))
+                else:
+                    options['read_preference'] = preference()
+            if read_concern and read_class in read_concern:
+                options['read_concern'] = ReadConcern(read_concern[read_class])
+
+            if options:
+                self._read_cols[read_class] = (
+                    self._col.with_options(**options),
+                    self._buckets.with_options(**options),
+                    self._archive.with_options(**options)
+                )
+            else:
+                self._read_cols[read_class] = (self._col, self._buckets, self._archive)
+
+        self.read_your_writes = read_your_writes
+        self._writes = {}
+
+    def _reader(self, read_class: str, user_id: str | None = None) -> T.Tuple['Collection', 'Collection', 'Collection']:
+        """
+        Returns users, buckets and archive collections for read.
+        """
+        if self.read_your_writes is not None and user_id is not None:
+            written = self._writes.get(user_id)
+            if written is not None and time.monotonic() - written < self.read_your_writes:
+                return self._col, self._buckets, self._archive
+        return self._read_cols[read_class]
+
+    def _archive_cutoff(self) -> datetime | None:
+        """
+        Buckets of months before cutoff are archived.
+        """
+        if self.archive_after is None:
+            return None
+        return month_start(datetime.now() - self.archive_after)
+
+    def _reaches_archive(self, since: datetime | None = None) -> bool:
+        if not self._has_archive or since is None:
+            return False
+        cutoff = self._archive_cutoff()
+        return cutoff is None or month_start(since) < cutoff
+
+    @staticmethod
+    def _find_items(collections: T.Iterable['Collection'], match: T.Dict[str, T.Any]) -> T.Dict[str, T.Any]:
+        """
+        Reads items of matched buckets, items of later collections override ones of earlier collections.
+        """
+        result = {}
+        for collection in collections:
+            for bucket in collection.find(match, {'_id': False, 'items': True}, sort=[('month', ASCENDING)]):
+                result.update(bucket['items'])
+        return result
+
+    def _write_buckets(self, user_id: str, requests: T.List[T.Any], descriptions: T.Iterable[str]) -> None:
+        """
+        Writes requests to buckets and removes written descriptions from archive,
+        so each item is stored either in buckets or in archive.
+        """
+        self._buckets.bulk_write(requests)
+        if self._has_archive:
+            requests = self._unset_items_requests(user_id, descriptions)
+            if requests:
+                self._archive.bulk_write(requests)
+
+    def _on_write(self, user_id: str, descriptions: T.Iterable[str] = (), upsert: bool = False) -> None:
+        """
+        Bumps user version after its buckets are written, `upsert` creates missing user in the same update.
+        """
+        descriptions = sorted(set(descriptions))
+        if descriptions or upsert:
+            # Version and its log entry are written atomically, so readers never see version without its changes
+            self._col.update_one({'user_id': user_id}, [
+                {'$set': {'version': {'$add': [{'$ifNull': ['$version', 0]}, 1]}}},
+                {'$set': {'changes': {'$slice': [
+                    {'$concatArrays': [
+                        {'$ifNull': ['$changes', []]},
+                        [{'v': '$version', 'd': {'$literal': descriptions}}]
+                    ]},
+                    -self.max_changes
+                ]}}}
+            ], upsert=upsert)
+
+        if self.read_your_writes is None:
+            return
+
+        now = time.monotonic()
+        if len(self._writes) >= self.max_tracked_writes:
+            self._writes = {k: t for k, t in self._writes.items() if now - t < self.read_your_writes}
+        self._writes[user_id] = now
+
+    def _user_exists(self, user_id: str) -> bool:
+        return self._col.count_documents({'user_id': user_id}, limit=1) > 0
+
+    @staticmethod
+    def _set_items_requests(
+        user_id: str,
+        items: T.Iterable[Item]
+    ) -> T.List[T.Union[UpdateOne, UpdateMany, DeleteMany]]:
+        """
+        Builds requests which put items to buckets of their months
+        and remove items with the same descriptions from other buckets.
+        """
+        months = {}
+        for item in items:
+            months.setdefault(month_start(item.time), []).append(item)
+
+        requests = []
+        for month, month_items in months.items():
+            fields = {f'items.{desc}': value for desc, value in UserItems(month_items).to_dict().items()}
+
+            requests.append(UpdateMany(
+                {'user_id': user_id, 'month': {'$ne': month}, '$or': [{f: {'$exists': True}} for f in fields]},
+                [BUCKET_UPGRADE_STAGE, {'$unset': list(fields)}, BUCKET_SUMMARY_STAGE]
+            ))
+            requests.append(UpdateOne(
+                {'user_id': user_id, 'month': month},
+                [
+                    BUCKET_UPGRADE_STAGE,
+                    {'$set': {f: {'$literal': value} for f, value in fields.items()}},
+                    BUCKET_SUMMARY_STAGE
+                ],
+                upsert=True
+            ))
+
+        # Items moved to another month may leave empty buckets
+        if len(requests) > 0:
+            requests.append(DeleteMany({'user_id': user_id, 'items': {}}))
+        return requests
+
+    @staticmethod
+    def _unset_items_requests(user_id: str, fields: T.Iterable[str]) -> T.List[T.Union[UpdateMany, DeleteMany]]:
+        fields = [f'items.{desc}' for desc in fields]
+        if not fields:
+            return []
+
+        return [
+            UpdateMany(
+                {'user_id': user_id, '$or': [{f: {'$exists': True}} for f in fields]},
+                [BUCKET_UPGRADE_STAGE, {'$unset': fields}, BUCKET_SUMMARY_STAGE]
+            ),
+            DeleteMany({'user_id': user_id, 'items': {}})
+        ]
 
     def create_user(self, user_id: str, init_data: UserItems | None = None) -> None:
-        if init_data is None:
-            data = {'_id': ObjectId(), 'user_id': user_id}
+        self._col.insert_one({'_id': ObjectId(), 'user_id': user_id})
+        if init_data is not None and init_data.items:
+            descriptions = [item.description for item in init_data.items]
+            self._write_buckets(user_id, self._set_items_requests(user_id, init_data.items), descriptions)
+            self._on_write(user_id, descriptions)
         else:
-            data = {'_id': ObjectId(), 'user_id': user_id, **init_data.to_dict()}
-        self._col.insert_one(data)
+            self._on_write(user_id)
 
     def delete_user(self, user_id: str) -> None:
         self._col.delete_one({"user_id": user_id})
+        self._buckets.delete_many({"user_id": user_id})
+        if self._has_archive:
+            self._archive.delete_many({"user_id": user_id})
+        self._on_write(user_id)
 
-    def get_data_by_id(self, user_id: str) -> UserItems:
-        result: dict = self._col.find_one({"user_id": user_id})
+    def get_data_by_id(
+        self,
+        user_id: str,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        limit: int | None = None
+    ) -> UserItems:
+        _, buckets, archive = self._reader('get_data_by_id', user_id)
 
-        if result is None:
-            return UserItems()
+        # Buckets out of time range are skipped by (user_id, month) index
+        match: T.Dict[str, T.Any] = {'user_id': user_id}
+        if since is not None or until is not None:
+            match['month'] = {}
+            if since is not None:
+                match['month']['$gte'] = month_start(since)
+            if until is not None:
+                match['month']['$lte'] = month_start(until)
+
+        if since is None and until is None and min_price is None and max_price is None and limit is None:
+            result = self._find_items((buckets,), match)
+        elif self._reaches_archive(since):
+            # Items override their copies left in archive by interrupted archival
+            pipeline = self._items_pipeline(match, since, until, min_price, max_price, limit, hot=False)
+            pipeline.insert(1, {'$unionWith': {
+                'coll': buckets.name,
+                'pipeline': [{'$match': match}, {'$addFields': {'hot': True}}]
+            }})
+            result = {item['k']: item['v'] for item in archive.aggregate(pipeline)}
         else:
-            del result['_id'], result['user_id']
-            return UserItems.from_dict(result)
+            pipeline = self._items_pipeline(match, since, until, min_price, max_price, limit)
+            result = {item['k']: item['v'] for item in buckets.aggregate(pipeline)}
+
+        return UserItems.from_dict(result)
+
+    @staticmethod
+    def _items_pipeline(
+        match: T.Dict[str, T.Any],
+        since: datetime | None = None,
+        until: datetime | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        limit: int | None = None,
+        hot: bool | None = None
+    ) -> T.List[dict]:
+        """
+        Builds aggregation pipeline which returns filtered items of matched buckets
+        as documents {k: description, v: [time, price]}.
+        If `hot` is not None, buckets without `hot` field are treated as `hot` and
+        items of the same description are merged preferring ones of hot buckets.
+        """
+        item_time = {'$arrayElemAt': ['$$item.v', 0]}
+        price = {'$arrayElemAt': ['$$item.v', 1]}
+
+        conditions: T.List[dict] = []
+        if since is not None:
+            conditions.append({'$gte': [item_time, encode_time(since)]})
+        if until is not None:
+            conditions.append({'$lte': [item_time, encode_time(until)]})
+        if min_price is not None:
+            conditions.append({'$gte': [price, min_price * PRICE_SCALE]})
+        if max_price is not None:
+            conditions.append({'$lte': [price, max_price * PRICE_SCALE]})
+
+        pipeline = [
+            {'$match': match},
+            BUCKET_READ_STAGE,
+            {'$project': {'_id': False, 'items': {'$filter': {
+                'input': {'$objectToArray': '$items'},
+                'as': 'item',
+                'cond': {'$and': conditions} if conditions else True
+            }}}},
+            {'$unwind': '$items'},
+            {'$replaceRoot': {'newRoot': '$items'}}
+        ]
+        if hot is not None:
+            pipeline[2]['$project']['hot'] = {'$ifNull': ['$hot', hot]}
+            pipeline[-1] = {'$project': {'k': '$items.k', 'v': '$items.v', 'hot': True}}
+            pipeline += [
+                {'$sort': {'k': 1, 'hot': 1}},
+                {'$group': {'_id': '$k', 'v': {'$last': '$v'}}},
+                {'$project': {'_id': False, 'k': '$_id', 'v': True}}
+            ]
+
+        if limit is not None:
+            pipeline += [
+                {'$addFields': {'t': {'$arrayElemAt': ['$v', 0]}}},
+                {'$sort': {'t': -1}},
+                {'$limit': limit},
+                {'$project': {'t': False}}
+            ]
+        return pipeline
+
+    def get_items_page(
+        self,
+        user_id: str,
+        page: int,
+        page_size: int,
+        sort_key: SortKey = 'time',
+        sort_desc: bool = False
+    ) -> T.Tuple[UserItems, int]:
+        check_sort_key(sort_key)
+        _, buckets, _ = self._reader('get_data_by_id', user_id)
+        sort_field = {'time': 't', 'price': 'p', 'description': 'k'}[sort_key]
+
+        query = buckets.aggregate([
+            {'$match': {'user_id': user_id}},
+            BUCKET_READ_STAGE,
+            {'$project': {'_id': False, 'items': {'$objectToArray': '$items'}}},
+            {'$unwind': '$items'},
+            {'$replaceRoot': {'newRoot': '$items'}},
+            {'$addFields': {
+                't': {'$arrayElemAt': ['$v', 0]},
+                'p': {'$arrayElemAt': ['$v', 1]}
+            }},
+            {'$sort': {sort_field: -1 if sort_desc else 1, 'k': 1}},
+            {'$facet': {
+                'items': [{'$skip': page*page_size}, {'$limit': page_size}, {'$project': {'k': True, 'v': True}}],
+                'total': [{'$count': 'n'}]
+            }}
+        ])
+        result = next(query)
+
+        items = UserItems.from_dict({item['k']: item['v'] for item in result['items']})
+        total = result['total'][0]['n'] if result['total'] else 0
+        return items, total
+
+    def get_summary(self, user_id: str) -> UserSummary:
+        _, buckets, _ = self._reader('aggregate', user_id)
+        query = buckets.aggregate([
+            {'$match': {'user_id': user_id}},
+            BUCKET_READ_STAGE,
+            BUCKET_READ_SUMMARY_STAGE,
+            {'$group': {
+                '_id': None,
+                'count': {'$sum': '$count'},
+                'total': {'$sum': '$sum'},
+                'min_price': {'$min': '$min'},
+                'max_price': {'$max': '$max'},
+                'updated': {'$max': '$updated'}
+            }}
+        ])
+        result = next(query, None)
+
+        if result is None:
+            return UserSummary()
+        del result['_id']
+        for field in ('total', 'min_price', 'max_price'):
+            if result[field] is not None:
+                result[field] /= PRICE_SCALE
+        return UserSummary(**result)
 
     def add_data_by_id(self, user_id: str, data: UserItems) -> None:
-        self._col.update_one({'user_id': user_id}, {'$set': data.to_dict()})
+        # Items of unknown users are ignored
+        if not data.items or not self._user_exists(user_id):
+            return
+
+        descriptions = [item.description for item in data.items]
+        self._write_buckets(user_id, self._set_items_requests(user_id, data.items), descriptions)
+        self._on_write(user_id, descriptions)
+
+    def upsert_data_by_id(self, user_id: str, data: UserItems) -> None:
+        descriptions = [item.description for item in data.items]
+        if data.items:
+            self._write_buckets(user_id, self._set_items_requests(user_id, data.items), descriptions)
+        # User is listed only after its buckets are written
+        self._on_write(user_id, descriptions, upsert=True)
 
     def delete_data_by_id(self, user_id: str, fields: T.List[str]) -> None:
-        self._col.update_one({'user_id': user_id}, {'$unset': {f: "" for f in fields}})
+        requests = self._unset_items_requests(user_id, fields)
+        if requests:
+            self._write_buckets(user_id, requests, fields)
+            self._on_write(user_id, fields)
+
+    def apply_ops(self, user_id: str, ops: T.List[Operation]) -> None:
+        # Merge operations in order, so later operation on the same item overrides earlier one
+        set_items = {}
+        unset_fields = set()
+        for op, arg in ops:
+            match op:
+                case 'set':
+                    for item in arg.items:
+                        unset_fields.discard(item.description)
+                        set_items[item.description] = item
+                case 'unset':
+                    for desc in arg:
+                        set_items.pop(desc, None)
+                        unset_fields.add(desc)
+                case _:
+                    raise ValueError(f"Unknown operation '{op}'")
+
+        if not set_items and not unset_fields:
+            return
+        if set_items and not self._user_exists(user_id):
+            return
+
+        # All operations are sent in one bulk write
+        requests = self._unset_items_requests(user_id, unset_fields)
+        requests += self._set_items_requests(user_id, set_items.values())
+        self._write_buckets(user_id, requests, [*set_items, *unset_fields])
+        self._on_write(user_id, [*set_items, *unset_fields])
+
+    def changes_since(self, user_id: str, version: int, epoch: str | None = None) -> UserChanges:
+        users, buckets, _ = self._reader('get_data_by_id', user_id)
+        doc = users.find_one({'user_id': user_id}, {'_id': True, 'version': True, 'changes': True})
+        if doc is None:
+            return UserChanges(snapshot=True)
+
+        current_epoch = str(doc['_id'])
+        current = doc.get('version', 0)
+        changes = doc.get('changes', [])
+        same_epoch = epoch == current_epoch
+        if same_epoch and version == current and version > 0:
+            return UserChanges(epoch=current_epoch, version=current)
+
+        # Client holding nothing, version of other epoch (deleted and created again user) or truncated log
+        if not same_epoch or version <= 0 or version > current or not changes or changes[0]['v'] > version + 1:
+            return UserChanges(
+                epoch=current_epoch, version=current, snapshot=True, items=self.get_data_by_id(user_id)
+            )
+
+        descriptions = {desc for entry in changes if entry['v'] > version for desc in entry['d']}
+        fields = [f'items.{desc}' for desc in descriptions]
+        # Written items are removed from archive and archived ones are reported deleted, so archive is not read
+        items = {}
+        for bucket in buckets.find(
+            {'user_id': user_id, '$or': [{f: {'$exists': True}} for f in fields]},
+            {'_id': False, **{f: True for f in fields}}
+        ):
+            items.update(bucket['items'])
+
+        return UserChanges(
+            epoch=current_epoch,
+            version=current,
+            items=UserItems.from_dict(items),
+            deleted=sorted(descriptions - items.keys())
+        )
 
     def iter_all_users(self, pid: int, n: int) -> T.List[str]:
-        query = self._col.find({}, {'user_id': True}, skip=pid*n, limit=n)
+        users, _, _ = self._reader('iter_all_users')
+        query = users.find({}, {'_id': False, 'user_id': True}, sort=[('user_id', ASCENDING)], skip=pid*n, limit=n)
         return [data['user_id'] for data in query]
 
+    def iter_users_after(self, after: str | None, n: int) -> T.List[str]:
+        users, _, _ = self._reader('iter_all_users')
+        query = users.find(
+            {} if after is None else {'user_id': {'$gt': after}},
+            {'_id': False, 'user_id': True},
+            sort=[('user_id', ASCENDING)],
+            limit=n
+        )
+        return [data['user_id'] for data in query]
+
+    def export_users(self, user_ids: T.List[str]) -> T.Iterator[T.Tuple[str, UserItems]]:
+        """
+        Reads buckets of all given users in one query per collection, archived items are included.
+        """
+        _, buckets, archive = self._reader('get_data_by_id')
+        items = {user_id: {} for user_id in user_ids}
+        # Items override their copies left in archive by interrupted archival
+        for collection in (archive, buckets) if self._has_archive else (buckets,):
+            for bucket in collection.find(
+                {'user_id': {'$in': list(user_ids)}},
+                {'_id': False, 'user_id': True, 'items': True},
+                sort=[('user_id', ASCENDING), ('month', ASCENDING)]
+            ):
+                items[bucket['user_id']].update(bucket['items'])
+
+        for user_id in user_ids:
+            yield user_id, UserItems.from_dict(items[user_id])
+
+    def dedupe_users(self, max_attempts: int = 3) -> int:
+        """
+        Merges user documents with the same `user_id` created by concurrent writes before index was unique,
+        and rebuilds `user_id` index as unique. The oldest document is kept with legacy item fields
+        of removed ones it does not have, its changes log is dropped, so clients refetch user data.
+        Users created while migration runs may make index build fail, then duplicates are merged again.
+        Returns number of removed documents.
+        """
+        removed = 0
+        for attempt in range(max_attempts):
+            query = self._col.aggregate([
+                {'$group': {'_id': '$user_id', 'ids': {'$push': '$_id'}, 'n': {'$sum': 1}}},
+                {'$match': {'n': {'$gt': 1}}}
+            ], allowDiskUse=True)
+
+            for group in query:
+                docs = sorted(self._col.find({'_id': {'$in': group['ids']}}), key=lambda doc: doc['_id'])
+                keep, duplicates = docs[0], docs[1:]
+
+                fields = {}
+                for doc in reversed(duplicates):
+                    fields.update({k: v for k, v in doc.items() if k not in RESERVED_FIELDS and k not in keep})
+                version = max(doc.get('version', 0) for doc in docs) + 1
+                self._col.update_one({'_id': keep['_id']}, {'$set': {**fields, 'version': version, 'changes': []}})
+                removed += self._col.delete_many({'_id': {'$in': [doc['_id'] for doc in duplicates]}}).deleted_count
+
+            index = self._col.index_information().get(USER_ID_INDEX)
+            if index is not None and index.get('unique', False):
+                return removed
+            if index is not None:
+                self._col.drop_index(USER_ID_INDEX)
+            try:
+                self._col.create_index('user_id', name=USER_ID_INDEX, unique=True)
+                return removed
+            except DuplicateKeyError:
+                # Non-unique index is restored for reads until the next attempt
+                self._col.create_index('user_id', name=USER_ID_INDEX)
+                logger.warning("Users were duplicated during migration, attempt %d of %d", attempt + 1, max_attempts)
+        raise RuntimeError(f"Unique index was not built in {max_attempts} attempts, stop writes and run again")
+
+    def migrate_to_buckets(self, batch_size: int = 100) -> int:
+        """
+        Moves items stored as fields of user documents to buckets. Migration can be interrupted and resumed,
+        each user is migrated by its buckets write followed by removing items from user document.
+        Returns number of migrated users.
+        """
+        legacy = {'$expr': {'$gt': [
+            {'$size': {'$filter': {
+                'input': {'$objectToArray': '$$ROOT'},
+                'as': 'field',
+                'cond': {'$not': {'$in': ['$$field.k', list(RESERVED_FIELDS)]}}
+            }}},
+            0
+        ]}}
+
+        migrated = 0
+        while True:
+            docs = list(self._col.find(legacy, limit=batch_size))
+            if not docs:
+                return migrated
+
+            for doc in docs:
+                fields = {k: v for k, v in doc.items() if k not in RESERVED_FIELDS}
+                self._buckets.bulk_write(self._set_items_requests(doc['user_id'], UserItems.from_dict(fields).items))
+                self._col.update_one({'_id': doc['_id']}, {'$unset': {k: "" for k in fields}})
+                migrated += 1
+
+    def migrate_summaries(self) -> int:
+        """
+        Calculates summaries of buckets written before summaries were maintained.
+        Returns number of updated buckets.
+        """
+        return self._buckets.update_many(
+            {'count': {'$exists': False}}, [BUCKET_UPGRADE_STAGE, BUCKET_SUMMARY_STAGE]
+        ).modified_count
+
+    def migrate_encoding(self, batch_size: int = 100, workers: int | None = None) -> int:
+        """
+        Upgrades buckets stored in legacy encoding to `SCHEMA_VERSION`, batches of buckets are upgraded
+        in thread pool. Migration can be interrupted and resumed, as only not upgraded buckets are selected
+        and each bucket is upgraded with its summary in one atomic update.
+        Returns number of upgraded buckets.
+        """
+        legacy = {'schema': {'$ne': SCHEMA_VERSION}}
+
+        def upgrade(ids: T.List[ObjectId]) -> int:
+            return self._buckets.update_many(
+                {'_id': {'$in': ids}, **legacy}, [BUCKET_UPGRADE_STAGE, BUCKET_SUMMARY_STAGE]
+            ).modified_count
+
+        migrated = 0
+        last_id = None
+        with ThreadPoolExecutor(workers) as pool:
+            # Bound number of batches in flight, so ids of whole collection are never held in memory
+            max_pending = 2 * pool._max_workers  # noqa
+            pending = collections.deque()
+
+            while True:
+                query = legacy if last_id is None else {'_id': {'$gt': last_id}, **legacy}
+                query = self._buckets.find(query, {'_id': True}, sort=[('_id', ASCENDING)], limit=batch_size)
+                ids = [doc['_id'] for doc in query]
+                if not ids:
+                    break
+                last_id = ids[-1]
+
+                if len(pending) >= max_pending:
+                    migrated += pending.popleft().result()
+                pending.append(pool.submit(upgrade, ids))
+
+            while pending:
+                migrated += pending.popleft().result()
+        return migrated
+
+    def archive(self, batch_size: int = 100, max_rate: float | None = None) -> int:
+        """
+        Moves buckets of months older than `archive_after` to archive, at most `max_rate` buckets per second.
+        Bucket is merged to archive bucket of its month and then removed if it was not changed meanwhile,
+        otherwise its items are removed from archive and bucket is left for the next run.
+        Archival can be interrupted and resumed, reads of both collections override items left in archive
+        by bucket items.
+        Legacy encoded buckets are skipped until `migrate_encoding`.
+        Returns number of archived buckets.
+        """
+        cutoff = self._archive_cutoff()
+        if cutoff is None:
+            raise ValueError("Archive age is not configured")
+        self._has_archive = True
+
+        old = {'month': {'$lt': cutoff}, 'schema': SCHEMA_VERSION}
+        archived = 0
+        last_id = None
+        while True:
+            started = time.monotonic()
+            query = old if last_id is None else {'_id': {'$gt': last_id}, **old}
+            buckets = list(self._buckets.find(query, sort=[('_id', ASCENDING)], limit=batch_size))
+            if not buckets:
+                return archived
+            last_id = buckets[-1]['_id']
+
+            for bucket in buckets:
+                user_id = bucket['user_id']
+                self._archive.update_one(
+                    {'user_id': user_id, 'month': bucket['month']},
+                    [
+                        BUCKET_UPGRADE_STAGE,
+                        {'$set': {f'items.{desc}': {'$literal': value} for desc, value in bucket['items'].items()}},
+                        BUCKET_SUMMARY_STAGE
+                    ],
+                    upsert=True
+                )
+                if self._buckets.delete_one({'_id': bucket['_id'], 'items': bucket['items']}).deleted_count:
+                    # Archived items leave default reads, so clients drop them with the next changes
+                    self._on_write(user_id, bucket['items'])
+                    archived += 1
+                else:
+                    self._archive.bulk_write(self._unset_items_requests(user_id, bucket['items']))
+
+            if max_rate is not None:
+                time.sleep(max(0.0, len(buckets) / max_rate - (time.monotonic() - started)))
+
     def __del__(self):
         self._client.close()
 
 
+class ResponseError(RequestError):
+    """
+    Not successful response of server, server answers 404 on any failure of database call.
+    """
+    status_code: int
+
+    def __init__(self, res: Response):
+        super().__init__(str(res.content), request=res.request)
+        self.status_code = res.status_code
+
+
 class WebDatabase(AppDatabase):
+    """
+    Keeps copies of last `cache_size` fetched users data, which are updated by changes since their versions
+    on each unfiltered `get_data_by_id`.
+    """
     host: str
     port: str
 
+    max_retries: int
+    max_retry_after: float
+    cache_size: int
+
     _url: str
     _client: Client
+    # user_id -> (epoch, version, items in `UserItems.to_dict` format), in order of use
+    _cache: collections.OrderedDict
+    _cache_lock: threading.Lock
 
-    def __init__(self, host: str, port: str):
+    def __init__(
+        self,
+        host: str,
+        port: str,
+        max_retries: int = 3,
+        max_retry_after: float = 10.0,
+        cache_size: int = 100
+    ):
         self.host = host
         self.port = port
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self.cache_size = cache_size
         self._url = f"http://{host}:{port}"
         self._client = Client(http2=True)
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def _request(self, method: str, path: str, **kwargs) -> Response:
+        """
+        Sends request, if server is overloaded (429 or 503 status) waits `Retry-After` seconds and retries.
+        """
+        with tracing.span(f'web.{path.lstrip("/")}') as attrs:
+            trace = tracing.current()
+            if tracing.enabled() and trace is not None:
+                kwargs['headers'] = {tracing.TRACE_HEADER: trace[0], tracing.PARENT_SPAN_HEADER: trace[1]}
+
+            res = self._client.request(method, self._url + path, **kwargs)
+
+            for _ in range(self.max_retries):
+                if res.status_code not in (429, 503) or 'Retry-After' not in res.headers:
+                    break
+                try:
+                    retry_after = float(res.headers['Retry-After'])
+                except ValueError:
+                    break
+                if retry_after > self.max_retry_after:
+                    break
+
+                time.sleep(retry_after)
+                res = self._client.request(method, self._url + path, **kwargs)
+
+            attrs['status'] = res.status_code
+            return res
 
     def create_user(self, user_id: str, init_data: UserItems | None = None) -> None:
-        res = self._client.post(
-            self._url + '/create_user',
+        res = self._request(
+            'POST',
+            '/create_user',
             params=[("user_id", user_id)],
             json=None if init_data is None else init_data.to_dict()
         )
 
         if res.status_code != 200:
-            raise RequestError(str(res.content))
+            raise ResponseError(res)
 
     def delete_user(self, user_id: str) -> None:
-        res = self._client.get(
-            self._url + '/delete_user',
+        res = self._request(
+            'GET',
+            '/delete_user',
             params=[("user_id", user_id)]
         )
 
         if res.status_code != 200:
-            raise RequestError(str(res.content))
+            raise ResponseError(res)
 
-    def get_data_by_id(self, user_id: str) -> UserItems:
-        res = self._client.get(
-            self._url + '/get_data_by_id',
-            params=[("user_id", user_id)]
+    def get_data_by_id(
+        self,
+        user_id: str,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        limit: int | None = None
+    ) -> UserItems:
+        params = [("user_id", user_id)]
+        if since is not None:
+            params.append(("since", format_datetime(since)))
+        if until is not None:
+            params.append(("until", format_datetime(until)))
+        if min_price is not None:
+            params.append(("min_price", min_price))
+        if max_price is not None:
+            params.append(("max_price", max_price))
+        if limit is not None:
+            params.append(("limit", limit))
+
+        if len(params) == 1 and self.cache_size > 0:
+            return UserItems.from_dict(self._sync_cached(user_id))
+
+        res = self._request(
+            'GET',
+            '/get_data_by_id',
+            params=params
         )
 
         if res.status_code != 200:
-            raise RequestError(str(res.content))
+            raise ResponseError(res)
         else:
             return UserItems.from_dict(res.json())
 
+    def get_items_page(
+        self,
+        user_id: str,
+        page: int,
+        page_size: int,
+        sort_key: SortKey = 'time',
+        sort_desc: bool = False
+    ) -> T.Tuple[UserItems, int]:
+        check_sort_key(sort_key)
+        res = self._request(
+            'GET',
+            '/get_items_page',
+            params=[
+                ("user_id", user_id),
+                ("page", page),
+                ("page_size", page_size),
+                ("sort_key", sort_key),
+                ("sort_desc", sort_desc)
+            ]
+        )
+
+        if res.status_code != 200:
+            raise ResponseError(res)
+        else:
+            data = res.json()
+            return UserItems.from_dict(data['items']), data['total']
+
+    def get_summary(self, user_id: str) -> UserSummary:
+        res = self._request(
+            'GET',
+            '/get_summary',
+            params=[("user_id", user_id)]
+        )
+
+        if res.status_code != 200:
+            raise ResponseError(res)
+        else:
+            return UserSummary.from_dict(res.json())
+
+    def get_chart(self, user_id: str, kind: str = 'pie', image_format: str = 'png') -> bytes:
+        """
+        Returns image of user items chart rendered by server.
+        """
+        res = self._request(
+            'GET',
+            '/chart',
+            params=[("user_id", user_id), ("kind", kind), ("format", image_format)]
+        )
+
+        if res.status_code != 200:
+            raise ResponseError(res)
+        else:
+            return res.content
+
     def add_data_by_id(self, user_id: str, data: UserItems) -> None:
-        res = self._client.post(
-            self._url + '/add_data_by_id',
+        res = self._request(
+            'POST',
+            '/add_data_by_id',
+            params=[("user_id", user_id)],
+            json=data.to_dict()
+        )
+
+        if res.status_code != 200:
+            raise ResponseError(res)
+
+    def upsert_data_by_id(self, user_id: str, data: UserItems) -> None:
+        res = self._request(
+            'POST',
+            '/upsert_data_by_id',
             params=[("user_id", user_id)],
             json=data.to_dict()
         )
 
         if res.status_code != 200:
-            raise RequestError(str(res.content))
+            raise ResponseError(res)
 
     def delete_data_by_id(self, user_id: str, fields: T.List[str]) -> None:
-        res = self._client.post(
-            self._url + '/delete_data_by_id',
+        res = self._request(
+            'POST',
+            '/delete_data_by_id',
             params=[("user_id", user_id)],
             json=fields
         )
 
         if res.status_code != 200:
-            raise RequestError(str(res.content))
+            raise ResponseError(res)
+
+    def apply_ops(self, user_id: str, ops: T.List[Operation]) -> None:
+        res = self._request(
+            'POST',
+            '/apply_ops',
+            params=[("user_id", user_id)],
+            json=ops_to_list(ops)
+        )
+
+        if res.status_code != 200:
+            raise ResponseError(res)
+
+    def changes_since(self, user_id: str, version: int, epoch: str | None = None) -> UserChanges:
+        params = [("user_id", user_id), ("version", version)]
+        if epoch is not None:
+            params.append(("epoch", epoch))
+        res = self._request(
+            'GET',
+            '/changes_since',
+            params=params
+        )
+
+        if res.status_code != 200:
+            raise ResponseError(res)
+        else:
+            return UserChanges.from_dict(res.json())
+
+    def _sync_cached(self, user_id: str) -> T.Dict[str, T.Any]:
+        """
+        Applies changes since cached version to cached copy of user data, returns updated copy.
+        """
+        with self._cache_lock:
+            epoch, version, data = self._cache.get(user_id, (None, 0, {}))
+
+        changes = self.changes_since(user_id, version, epoch)
+        data = changes.apply(data)
+
+        with self._cache_lock:
+            # Concurrent sync may have cached newer version of the same epoch already
+            cached_epoch, cached_version, _ = self._cache.get(user_id, (None, -1, None))
+            if changes.epoch != cached_epoch or changes.version >= cached_version:
+                self._cache[user_id] = (changes.epoch, changes.version, data)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return data
+
+    def subscribe(
+        self,
+        user_id: str,
+        on_change: T.Callable[[T.List[Operation] | None], None],
+        reconnect_delay: float = 5.0
+    ) -> T.Callable[[], None]:
+        """
+        Listens user changes feed in background thread. `on_change` is called from this thread
+        with list of operations or with `None` if all user data must be refetched.
+        Returns function which stops listening.
+        """
+        from websockets.sync.client import connect
+        from websockets.exceptions import WebSocketException
+
+        stop = threading.Event()
+        connection = None
+
+        def listen():
+            nonlocal connection
+            reconnect = False
+
+            while not stop.is_set():
+                try:
+                    with connect(f"ws://{self.host}:{self.port}/changes?user_id={quote_plus(user_id)}") as connection:
+                        # Changes made while disconnected are lost
+                        if reconnect:
+                            on_change(None)
+                        reconnect = True
+
+                        for message in connection:
+                            events = json.loads(message)
+                            if any(event['op'] == 'reset' for event in events):
+                                on_change(None)
+                            else:
+                                on_change(ops_from_list(events))
+                except (OSError, WebSocketException):
+                    pass
+                stop.wait(reconnect_delay)
+
+        def unsubscribe():
+            stop.set()
+            if connection is not None:
+                connection.close()
+
+        threading.Thread(target=listen, daemon=True).start()
+        return unsubscribe
 
     def iter_all_users(self, pid: int, n: int) -> T.List[str]:
-        res = self._client.get(
-            self._url + '/iter_all_users',
+        res = self._request(
+            'GET',
+            '/iter_all_users',
             params=[("pid", pid), ("n", n)]
         )
 
         return res.json()
 
+    def iter_users_after(self, after: str | None, n: int) -> T.List[str]:
+        params = [("n", n)]
+        if after is not None:
+            params.append(("after", after))
+
+        res = self._request(
+            'GET',
+            '/iter_users_after',
+            params=params
+        )
+
+        if res.status_code != 200:
+            raise ResponseError(res)
+        else:
+            return res.json()
+
     def __del__(self):
         self._client.close()
 
 
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key, so only the first caller executes function
+    and others wait for its result. Sync (`do`) and async (`do_async`) callers share the same in-flight calls.
+    """
+    _calls: T.Dict[T.Hashable, Future]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def _join(self, key: T.Hashable) -> T.Tuple[Future, bool]:
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def _run(self, key: T.Hashable, future: Future, fn: T.Callable[[], T.Any]) -> None:
+        try:
+            future.set_result(fn())
+        except BaseException as ex:
+            future.set_exception(ex)
+        finally:
+            with self._lock:
+                if self._calls.get(key) is future:
+                    del self._calls[key]
+
+    def do(self, key: T.Hashable, fn: T.Callable[[], T.Any]) -> T.Any:
+        future, is_leader = self._join(key)
+        if is_leader:
+            self._run(key, future, fn)
+        return future.result()
+
+    async def do_async(self, key: T.Hashable, fn: T.Callable[[], T.Any]) -> T.Any:
+        """
+        Blocking `fn` will be executed in default executor of running loop, in copy of caller context.
+        """
+        future, is_leader = self._join(key)
+        if is_leader:
+            context = contextvars.copy_context()
+            await asyncio.get_running_loop().run_in_executor(None, context.run, self._run, key, future, fn)
+        return await asyncio.wrap_future(future)
+
+    def forget(self, predicate: T.Callable[[T.Hashable], bool]) -> None:
+        """
+        Next calls with keys matching predicate will not join calls which are in-flight now.
+        """
+        with self._lock:
+            for key in [k for k in self._calls if predicate(k)]:
+                del self._calls[key]
+
+
+class CoalescingDatabase(AppDatabase):
+    """
+    Wraps database so concurrent identical reads share one database call and one decoded result.
+    Results are shared between callers, so they must not be mutated.
+    """
+    _db: AppDatabase
+    _flight: SingleFlight
+
+    def __init__(self, database: AppDatabase):
+        self._db = database
+        self._flight = SingleFlight()
+
+    def _forget_user(self, user_id: str) -> None:
+        # Reads started before write must not be joined by reads started after it
+        self._flight.forget(lambda key: key[0] not in ('iter_all_users', 'iter_users_after') and key[1] == user_id)
+
+    def create_user(self, user_id: str, init_data: UserItems | None = None) -> None:
+        self._db.create_user(user_id, init_data)
+        self._forget_user(user_id)
+        self._flight.forget(lambda key: key[0] in ('iter_all_users', 'iter_users_after'))
+
+    def delete_user(self, user_id: str) -> None:
+        self._db.delete_user(user_id)
+        self._forget_user(user_id)
+        self._flight.forget(lambda key: key[0] in ('iter_all_users', 'iter_users_after'))
+
+    def get_data_by_id(
+        self,
+        user_id: str,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        limit: int | None = None
+    ) -> UserItems:
+        args = (user_id, since, until, min_price, max_price, limit)
+        return self._flight.do(('get_data_by_id', *args), lambda: self._db.get_data_by_id(*args))
+
+    async def get_data_by_id_async(
+        self,
+        user_id: str,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        limit: int | None = None
+    ) -> UserItems:
+        args = (user_id, since, until, min_price, max_price, limit)
+        return await self._flight.do_async(('get_data_by_id', *args), lambda: self._db.get_data_by_id(*args))
+
+    def get_items_page(
+        self,
+        user_id: str,
+        page: int,
+        page_size: int,
+        sort_key: SortKey = 'time',
+        sort_desc: bool = False
+    ) -> T.Tuple[UserItems, int]:
+        args = (user_id, page, page_size, sort_key, sort_desc)
+        return self._flight.do(('get_items_page', *args), lambda: self._db.get_items_page(*args))
+
+    def get_summary(self, user_id: str) -> UserSummary:
+        return self._flight.do(('get_summary', user_id), lambda: self._db.get_summary(user_id))
+
+    def add_data_by_id(self, user_id: str, data: UserItems) -> None:
+        self._db.add_data_by_id(user_id, data)
+        self._forget_user(user_id)
+
+    def upsert_data_by_id(self, user_id: str, data: UserItems) -> None:
+        self._db.upsert_data_by_id(user_id, data)
+        self._forget_user(user_id)
+        self._flight.forget(lambda key: key[0] in ('iter_all_users', 'iter_users_after'))
+
+    def delete_data_by_id(self, user_id: str, fields: T.List[str]) -> None:
+        self._db.delete_data_by_id(user_id, fields)
+        self._forget_user(user_id)
+
+    def apply_ops(self, user_id: str, ops: T.List[Operation]) -> None:
+        self._db.apply_ops(user_id, ops)
+        self._forget_user(user_id)
+
+    def iter_all_users(self, pid: int, n: int) -> T.List[str]:
+        return self._flight.do(('iter_all_users', pid, n), lambda: self._db.iter_all_users(pid, n))
+
+    async def iter_all_users_async(self, pid: int, n: int) -> T.List[str]:
+        return await self._flight.do_async(('iter_all_users', pid, n), lambda: self._db.iter_all_users(pid, n))
+
+    def iter_users_after(self, after: str | None, n: int) -> T.List[str]:
+        return self._flight.do(('iter_users_after', after, n), lambda: self._db.iter_users_after(after, n))
+
+    def changes_since(self, user_id: str, version: int, epoch: str | None = None) -> UserChanges:
+        return self._flight.do(
+            ('changes_since', user_id, version, epoch), lambda: self._db.changes_since(user_id, version, epoch)
+        )
+
+
+class ShardedDatabase(AppDatabase):
+    """
+    Routes users to shards by consistent hash of `user_id`.
+    Shards must return users from `iter_all_users` sorted by `user_id`, so they can be merged.
+    """
+    virtual_nodes: int
+
+    _shards: T.Dict[str, AppDatabase]
+    _ring: T.List[T.Tuple[int, str]]
+
+    def __init__(self, shards: T.Dict[str, AppDatabase], virtual_nodes: int = 64):
+        self.virtual_nodes = virtual_nodes
+        self._shards = {}
+        self._ring = []
+
+        for name, database in shards.items():
+            self._add_to_ring(name, database)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def _add_to_ring(self, name: str, database: AppDatabase) -> None:
+        if name in self._shards:
+            raise ValueError(f"Shard '{name}' already exists")
+
+        self._shards[name] = database
+        for i in range(self.virtual_nodes):
+            bisect.insort(self._ring, (self._hash(f"{name}#{i}"), name))
+
+    @property
+    def shards(self) -> T.Dict[str, AppDatabase]:
+        return dict(self._shards)
+
+    def shard_name(self, user_id: str) -> str:
+        index = bisect.bisect(self._ring, (self._hash(user_id), '')) % len(self._ring)
+        return self._ring[index][1]
+
+    def shard(self, user_id: str) -> AppDatabase:
+        return self._shards[self.shard_name(user_id)]
+
+    def add_shard(self, name: str, database: AppDatabase, batch_size: int = 100) -> int:
+        """
+        Adds shard and moves to it users which it owns now. Returns number of moved users.
+        Must run with writes stopped: ring is switched before users are copied, so reads of moving users
+        miss their data until they are copied, and their concurrent writes race the copy and removal
+        from old shard. Moved users get new `changes_since` epoch.
+        """
+        old_shards = list(self._shards.items())
+        self._add_to_ring(name, database)
+
+        moved = 0
+        for old_name, old_database in old_shards:
+            moving = [
+                user_id for user_id in self._iter_shard(old_database, batch_size) if self.shard_name(user_id) == name
+            ]
+
+            # Export includes items which default reads skip (e.g. archived ones)
+            for user_id, data in old_database.export_users(moving):
+                database.upsert_data_by_id(user_id, data)
+                old_database.delete_user(user_id)
+            moved += len(moving)
+        return moved
+
+    def create_user(self, user_id: str, init_data: UserItems | None = None) -> None:
+        self.shard(user_id).create_user(user_id, init_data)
+
+    def delete_user(self, user_id: str) -> None:
+        self.shard(user_id).delete_user(user_id)
+
+    def get_data_by_id(
+        self,
+        user_id: str,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        limit: int | None = None
+    ) -> UserItems:
+        return self.shard(user_id).get_data_by_id(user_id, since, until, min_price, max_price, limit)
+
+    def get_items_page(
+        self,
+        user_id: str,
+        page: int,
+        page_size: int,
+        sort_key: SortKey = 'time',
+        sort_desc: bool = False
+    ) -> T.Tuple[UserItems, int]:
+        return self.shard(user_id).get_items_page(user_id, page, page_size, sort_key, sort_desc)
+
+    def get_summary(self, user_id: str) -> UserSummary:
+        return self.shard(user_id).get_summary(user_id)
+
+    def add_data_by_id(self, user_id: str, data: UserItems) -> None:
+        self.shard(user_id).add_data_by_id(user_id, data)
+
+    def upsert_data_by_id(self, user_id: str, data: UserItems) -> None:
+        self.shard(user_id).upsert_data_by_id(user_id, data)
+
+    def delete_data_by_id(self, user_id: str, fields: T.List[str]) -> None:
+        self.shard(user_id).delete_data_by_id(user_id, fields)
+
+    def apply_ops(self, user_id: str, ops: T.List[Operation]) -> None:
+        self.shard(user_id).apply_ops(user_id, ops)
+
+    @staticmethod
+    def _iter_shard(database: AppDatabase, batch_size: int, after: str | None = None) -> T.Iterator[str]:
+        while True:
+            users = database.iter_users_after(after, batch_size)
+            yield from users
+            if len(users) < batch_size:
+                break
+            after = users[-1]
+
+    def iter_all_users(self, pid: int, n: int) -> T.List[str]:
+        merged = heapq.merge(*[self._iter_shard(database, n) for database in self._shards.values()])
+        return list(itertools.islice(merged, pid*n, (pid+1)*n))
+
+    def changes_since(self, user_id: str, version: int, epoch: str | None = None) -> UserChanges:
+        return self.shard(user_id).changes_since(user_id, version, epoch)
+
+    def iter_users_after(self, after: str | None, n: int) -> T.List[str]:
+        merged = heapq.merge(*[database.iter_users_after(after, n) for database in self._shards.values()])
+        return list(itertools.islice(merged, n))
+
+    def export(self, batch_size: int = 100) -> T.Iterator[T.Tuple[str, UserItems]]:
+        return heapq.merge(
+            *[database.export(batch_size) for database in self._shards.values()],
+            key=lambda user_data: user_data[0]
+        )
+
+    def export_users(self, user_ids: T.List[str]) -> T.Iterator[T.Tuple[str, UserItems]]:
+        shard_users = {}
+        for user_id in user_ids:
+            shard_users.setdefault(self.shard_name(user_id), []).append(user_id)
+
+        data = {}
+        for name, users in shard_users.items():
+            data.update(self._shards[name].export_users(users))
+        for user_id in user_ids:
+            yield user_id, data[user_id]
+
+
 def Database() -> AppDatabase:  # noqa
     import const
 
     if not const._is_env_loaded: # noqa
         raise ImportError('Call `const.load_env` or `const.load_vars` before')
 
+    if const.TRACE_FILE and not tracing.enabled():
+        tracing.configure(const.TRACE_FILE)
+
+    read_options = dict(
+        read_preference=parse_per_read_class(const.MONGO_READ_PREFERENCE),
+        read_concern=parse_per_read_class(const.MONGO_READ_CONCERN),
+        max_staleness=parse_per_read_class(const.MONGO_MAX_STALENESS),
+        read_your_writes=float(const.MONGO_READ_YOUR_WRITES) if const.MONGO_READ_YOUR_WRITES else None,
+        slow_command_ms=float(const.MONGO_SLOW_COMMAND_MS) if const.MONGO_SLOW_COMMAND_MS else None,
+        check_indexes=bool(const.DEV_MODE),
+        archive_after=timedelta(days=float(const.MONGO_ARCHIVE_AFTER_DAYS)) if const.MONGO_ARCHIVE_AFTER_DAYS else None
+    )
+
     match const.DATABASE_TYPE:
         case "MONGO_DB":
             return MongoDatabase(
@@ -251,8 +1929,23 @@ def Database() -> AppDatabase:  # noqa
                 host=const.DATABASE_HOST,
                 port=int(const.DATABASE_PORT),
                 user=const.MONGO_USER,
-                password=const.MONGO_PASS
+                password=const.MONGO_PASS,
+                **read_options
             )
+        case "SHARDED_MONGO_DB":
+            shards = {}
+            for address in const.DATABASE_SHARDS.split(','):
+                host, _, port = address.strip().rpartition(':')
+                shards[address.strip()] = MongoDatabase(
+                    database=const.MONGO_DATABASE_NAME,
+                    collection=const.MONGO_COLLECTION_NAME,
+                    host=host,
+                    port=int(port),
+                    user=const.MONGO_USER,
+                    password=const.MONGO_PASS,
+                    **read_options
+                )
+            return ShardedDatabase(shards)
         case "WEB_DB":
             return WebDatabase(
                 host=const.DATABASE_HOST,
@@ -0,0 +1,186 @@
+import time
+import random
+import threading
+
+import numpy as np
+import typing as T  # noqa
+
+from concurrent.futures import ThreadPoolExecutor
+from database import AppDatabase, UserItems, Item
+
+
+OPERATIONS = ('get_data_by_id', 'add_data_by_id', 'delete_data_by_id', 'iter_all_users')
+DEFAULT_MIX = {
+    'get_data_by_id': 70,
+    'add_data_by_id': 20,
+    'delete_data_by_id': 5,
+    'iter_all_users': 5
+}
+
+
+def parse_mix(value: str | None) -> T.Dict[str, float]:
+    """
+    Parses operations mix like 'get_data_by_id=70,add_data_by_id=30'.
+    """
+    if not value:
+        return DEFAULT_MIX
+
+    mix = {}
+    for entry in value.split(','):
+        op, _, weight = entry.strip().partition('=')
+        if op not in OPERATIONS:
+            raise ValueError(f"Unknown operation '{op}', must be one of {OPERATIONS}")
+        mix[op] = float(weight)
+    return mix
+
+
+class LoadTest:
+    """
+    Simulates `users` virtual users, each working with its own user document.
+    In closed-loop mode (`rate` is None) every virtual user sends next request after previous one is done,
+    in open-loop mode requests arrive with Poisson `rate` per second regardless of server latency,
+    and latency is measured from the scheduled arrival time.
+    """
+    user_prefix: str = 'loadtest-user-'
+    items_per_user: int = 50
+    page_size: int = 10
+
+    database: AppDatabase
+    users: int
+    mix: T.Dict[str, float]
+    duration: float
+    rate: float | None
+
+    _latencies: T.Dict[str, T.List[float]]
+    _errors: T.Dict[str, int]
+
+    def __init__(
+        self,
+        database: AppDatabase,
+        users: int,
+        duration: float,
+        mix: T.Dict[str, float] | None = None,
+        rate: float | None = None,
+        seed: int | None = None
+    ):
+        self.database = database
+        self.users = users
+        self.duration = duration
+        self.mix = DEFAULT_MIX if mix is None else mix
+        self.rate = rate
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._latencies = {op: [] for op in self.mix}
+        self._errors = {op: 0 for op in self.mix}
+
+    def _user_id(self, user: int) -> str:
+        return f"{self.user_prefix}{user}"
+
+    def _choose(self, rng: random.Random) -> str:
+        return rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+
+    def _call(self, op: str, user: int, rng: random.Random) -> None:
+        user_id = self._user_id(user)
+
+        match op:
+            case 'get_data_by_id':
+                self.database.get_data_by_id(user_id)
+            case 'add_data_by_id':
+                item = Item(f"item{rng.randrange(self.items_per_user)}", round(rng.uniform(1, 1000), 2))
+                self.database.add_data_by_id(user_id, UserItems(item))
+            case 'delete_data_by_id':
+                self.database.delete_data_by_id(user_id, [f"item{rng.randrange(self.items_per_user)}"])
+            case 'iter_all_users':
+                self.database.iter_all_users(rng.randrange(max(1, self.users // self.page_size)), self.page_size)
+
+    def _run_op(self, op: str, user: int, rng: random.Random, started: float) -> None:
+        try:
+            self._call(op, user, rng)
+            failed = False
+        except Exception:  # noqa
+            failed = True
+        latency = time.perf_counter() - started
+
+        with self._lock:
+            if failed:
+                self._errors[op] += 1
+            else:
+                self._latencies[op].append(latency)
+
+    def setup(self) -> None:
+        for user in range(self.users):
+            self.database.upsert_data_by_id(self._user_id(user), UserItems())
+
+    def cleanup(self) -> None:
+        for user in range(self.users):
+            self.database.delete_user(self._user_id(user))
+
+    def _closed_loop(self, deadline: float) -> None:
+        def virtual_user(user: int, seed: int):
+            rng = random.Random(seed)
+            while time.perf_counter() < deadline:
+                self._run_op(self._choose(rng), user, rng, time.perf_counter())
+
+        threads = [
+            threading.Thread(target=virtual_user, args=(user, self._random.random()))
+            for user in range(self.users)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _open_loop(self, deadline: float) -> None:
+        with ThreadPoolExecutor(self.users) as pool:
+            arrival = time.perf_counter()
+
+            while True:
+                arrival += self._random.expovariate(self.rate)
+                if arrival >= deadline:
+                    break
+
+                delay = arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+                rng = random.Random(self._random.random())
+                pool.submit(self._run_op, self._choose(rng), rng.randrange(self.users), rng, arrival)
+
+    def run(self) -> T.Dict[str, T.Dict[str, float]]:
+        started = time.perf_counter()
+        deadline = started + self.duration
+
+        if self.rate is None:
+            self._closed_loop(deadline)
+        else:
+            self._open_loop(deadline)
+        return self.report(time.perf_counter() - started)
+
+    def report(self, elapsed: float) -> T.Dict[str, T.Dict[str, float]]:
+        out = {}
+        for op in self.mix:
+            latencies = np.array(self._latencies[op]) * 1000
+            errors = self._errors[op]
+            total = len(latencies) + errors
+            p50, p95, p99 = np.percentile(latencies, (50, 95, 99)) if len(latencies) else (np.nan,) * 3
+
+            out[op] = {
+                'requests': total,
+                'throughput': total / elapsed,
+                'error_rate': errors / total if total else 0.0,
+                'p50_ms': float(p50),
+                'p95_ms': float(p95),
+                'p99_ms': float(p99)
+            }
+        return out
+
+
+def format_report(report: T.Dict[str, T.Dict[str, float]]) -> str:
+    lines = [f"{'operation':<20}{'requests':>10}{'rps':>10}{'errors':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"]
+    for op, stats in report.items():
+        lines.append(
+            f"{op:<20}{stats['requests']:>10}{stats['throughput']:>10.1f}{stats['error_rate']:>9.2%}"
+            f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}"
+        )
+    return '\n'.join(lines)
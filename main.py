@@ -1,7 +1,12 @@
 import os
 import abc
+import sys
+import glob
+import time
 import dotenv
+import socket
 import argparse
+import statistics
 import subprocess
 
 import typing as T # noqa
@@ -21,12 +26,28 @@ load_vars(
     mongo_database_name={mongo_database_name},
     mongo_collection_name={mongo_collection_name},
     firebase_collection_name={firebase_collection_name},
-    firebase_credentials_name={firebase_credentials_name}
+    firebase_credentials_name={firebase_credentials_name},
+    database_shards={database_shards},
+    mongo_read_preference={mongo_read_preference},
+    mongo_read_concern={mongo_read_concern},
+    mongo_max_staleness={mongo_max_staleness},
+    mongo_read_your_writes={mongo_read_your_writes},
+    admission_max_concurrency={admission_max_concurrency},
+    admission_max_queue={admission_max_queue},
+    admission_queue_timeout={admission_queue_timeout},
+    rate_limit_per_user={rate_limit_per_user},
+    rate_limit_burst={rate_limit_burst},
+    trace_file={trace_file},
+    mongo_slow_command_ms={mongo_slow_command_ms},
+    mongo_archive_after_days={mongo_archive_after_days},
+    dev_mode={dev_mode}
 )
 """
 
 RUN_GEN = {
     'server': """
+import multiprocessing
+multiprocessing.freeze_support()
 from server import run
 run()
 """,
@@ -37,9 +58,48 @@ run(config={platform})
 """
 }
 
+# Probe starts runnable and stops it right away, so all modules imported on its start are known
+PROBE_GEN = {
+    'server': """
+import time
+import uvicorn
+import threading
+from server import app
+
+probe = uvicorn.Server(uvicorn.Config(app=app, port=0, log_level='warning'))
+thread = threading.Thread(target=probe.run)
+thread.start()
+while not probe.started and thread.is_alive():
+    time.sleep(0.01)
+probe.should_exit = True
+thread.join()
+""",
+    'client': """
+import os
+os.environ['EXIT_ON_START'] = '1'
+
+import websockets.sync.client
+from client import run
+run(config='desktop')
+"""
+}
+
+PROBE_REPORT = """
+from database import Database
+try:
+    Database()
+except Exception:
+    pass
+
+import sys
+print(' '.join(sorted({name.partition('.')[0] for name in sys.modules})))
+"""
+
+# Bundled by static analysis of some packages, but rarely imported
+STDLIB_EXCLUDE_CANDIDATES = ('tkinter', 'unittest', 'pydoc', 'doctest', 'lib2to3', 'idlelib', 'pdb', 'test')
+
 CONFIGS = {
     'server': [
-        '--exclude-module', 'matplotlib',
         '--exclude-module', 'matplotlib.pyplot',
         '--exclude-module', 'prompt_toolkit',
         '--exclude-module', 'PySide2',
@@ -81,32 +141,157 @@ def run(runnable: T.Literal['client', 'server']):
         raise ValueError("runnable arg must be one of ['client', 'server']")
 
 
+def snapshot(path: str, batch_size: int = 100):
+    from const import load_dotenv
+    load_dotenv('.env')
+
+    from database import Database
+    from snapshot import write_snapshot
+
+    meta = write_snapshot(Database(), path, batch_size)
+    print(f"Snapshot of {meta['users']} users and {meta['items']} items written to '{path}'")
+
+
+def _mongo_databases(migration: str) -> list:
+    from const import load_dotenv
+    load_dotenv('.env')
+
+    from database import Database, MongoDatabase, ShardedDatabase
+
+    database = Database()
+    if isinstance(database, ShardedDatabase):
+        databases = list(database.shards.values())
+    else:
+        databases = [database]
+
+    for db in databases:
+        if not isinstance(db, MongoDatabase):
+            raise ValueError(f"{migration} migration is available only for MONGO_DB and SHARDED_MONGO_DB databases")
+    return databases
+
+
+def dedupe_users():
+    for db in _mongo_databases('Users dedupe'):
+        print(f"Removed {db.dedupe_users()} duplicate users")
+
+
+def migrate_buckets(batch_size: int = 100):
+    for db in _mongo_databases('Buckets'):
+        print(f"Migrated {db.migrate_to_buckets(batch_size)} users")
+        print(f"Calculated summaries of {db.migrate_summaries()} buckets")
+
+
+def migrate_encoding(batch_size: int = 100, workers: int | None = None):
+    for db in _mongo_databases('Encoding'):
+        print(f"Upgraded encoding of {db.migrate_encoding(batch_size, workers)} buckets")
+
+
+def archive(batch_size: int = 100, max_rate: float | None = None):
+    for db in _mongo_databases('Archive'):
+        print(f"Archived {db.archive(batch_size, max_rate)} buckets")
+
+
+def trace_view(paths: T.List[str], top: int = 10):
+    from tracing import read_spans, summarize
+    print(summarize(read_spans(paths), top))
+
+
+def _open_database():
+    from const import load_dotenv
+    load_dotenv('.env')
+
+    from database import Database
+    return Database()
+
+
+def report(path: str, snapshot_path: str | None = None, chunk_size: int = 1000, workers: int | None = None):
+    import functools
+    from report import build_report, write_report
+
+    # Each report worker opens database itself
+    if snapshot_path is not None:
+        from snapshot import SnapshotDatabase
+        open_database = functools.partial(SnapshotDatabase, snapshot_path)
+    else:
+        open_database = _open_database
+
+    summary = build_report(open_database, chunk_size, workers)
+    write_report(summary, path)
+    print(f"Report of {summary['users']} users and {summary['items']} items written to '{path}'")
+
+
+def loadtest(
+    target: str | None,
+    users: int,
+    duration: float,
+    mix: str | None = None,
+    rate: float | None = None
+):
+    from const import load_dotenv
+    load_dotenv('.env')
+
+    import const
+    from database import WebDatabase
+    from loadtest import LoadTest, parse_mix, format_report
+
+    if target is not None:
+        host, _, port = target.rpartition(':')
+    else:
+        host, port = const.SERVER_HOST, const.SERVER_PORT
+
+    # Rejected requests are not retried and reads are not served from client cache,
+    # so report shows load shedding in error rate and latency of every request
+    database = WebDatabase(host, port, max_retries=0, cache_size=0)
+    test = LoadTest(database, users=users, duration=duration, mix=parse_mix(mix), rate=rate)
+    test.setup()
+    try:
+        print(format_report(test.run()))
+    finally:
+        test.cleanup()
+
+
 class Builder(abc.ABC):
+    @staticmethod
+    def _constants_code() -> str:
+        dotenv.load_dotenv('.env')
+
+        return CONSTANTS_GEN.format(
+            mongo_user=safe_env('MONGO_USER'),
+            mongo_pass=safe_env('MONGO_PASS'),
+            server_host=safe_env('SERVER_HOST'),
+            server_port=safe_env('SERVER_PORT'),
+            database_type=safe_env('DATABASE_TYPE'),
+            database_host=safe_env('DATABASE_HOST'),
+            database_port=safe_env('DATABASE_PORT'),
+            mongo_database_name=safe_env('MONGO_DATABASE_NAME'),
+            mongo_collection_name=safe_env('MONGO_COLLECTION_NAME'),
+            firebase_collection_name=safe_env('FIREBASE_COLLECTION_NAME'),
+            firebase_credentials_name=safe_env('FIREBASE_CREDENTIALS_PATH'),
+            database_shards=safe_env('DATABASE_SHARDS'),
+            mongo_read_preference=safe_env('MONGO_READ_PREFERENCE'),
+            mongo_read_concern=safe_env('MONGO_READ_CONCERN'),
+            mongo_max_staleness=safe_env('MONGO_MAX_STALENESS'),
+            mongo_read_your_writes=safe_env('MONGO_READ_YOUR_WRITES'),
+            admission_max_concurrency=safe_env('ADMISSION_MAX_CONCURRENCY'),
+            admission_max_queue=safe_env('ADMISSION_MAX_QUEUE'),
+            admission_queue_timeout=safe_env('ADMISSION_QUEUE_TIMEOUT'),
+            rate_limit_per_user=safe_env('RATE_LIMIT_PER_USER'),
+            rate_limit_burst=safe_env('RATE_LIMIT_BURST'),
+            trace_file=safe_env('TRACE_FILE'),
+            mongo_slow_command_ms=safe_env('MONGO_SLOW_COMMAND_MS'),
+            mongo_archive_after_days=safe_env('MONGO_ARCHIVE_AFTER_DAYS'),
+            dev_mode=safe_env('DEV_MODE')
+        )
+
     def _init_tmp(self, build_config: str) -> str: # noqa
 
         if not os.path.exists('tmp'):
             os.mkdir('tmp')
 
-        tmp_file = 'tmp\\main.py'
+        tmp_file = os.path.join('tmp', 'main.py')
 
         with open(tmp_file, 'x') as tmp:
-            dotenv.load_dotenv('.env')
-
-            code = CONSTANTS_GEN.format(
-                mongo_user=safe_env('MONGO_USER'),
-                mongo_pass=safe_env('MONGO_PASS'),
-                server_host=safe_env('SERVER_HOST'),
-                server_port=safe_env('SERVER_PORT'),
-                database_type=safe_env('DATABASE_TYPE'),
-                database_host=safe_env('DATABASE_HOST'),
-                database_port=safe_env('DATABASE_PORT'),
-                mongo_database_name=safe_env('MONGO_DATABASE_NAME'),
-                mongo_collection_name=safe_env('MONGO_COLLECTION_NAME'),
-                firebase_collection_name=safe_env('FIREBASE_COLLECTION_NAME'),
-                firebase_credentials_name=safe_env('FIREBASE_CREDENTIALS_PATH')
-            )
-            code += RUN_GEN[build_config]
-            tmp.write(code)
+            tmp.write(self._constants_code() + RUN_GEN[build_config])
         return tmp_file
 
     @abc.abstractmethod
@@ -115,17 +300,99 @@ class Builder(abc.ABC):
 
 
 class DesktopBuilder(Builder):
+    """
+    `default` profile builds one file binary. `startup` profile is optimized for launch time: one directory
+    binary (nothing is unpacked on launch) without UPX, with optimized bytecode and without modules which
+    runnable never imports, cold start time of built binary is measured after build.
+    """
+    profile: T.Literal['default', 'startup']
+
+    def __init__(self, profile: T.Literal['default', 'startup'] = 'default'):
+        self.profile = profile
+
+    def _unused_modules(self, build_config: str) -> T.List[str]:
+        """
+        Runs probe importing everything runnable imports, returns installed packages, project modules
+        and rarely used stdlib modules, which were not imported.
+        """
+        from importlib.metadata import packages_distributions
+
+        probe = self._constants_code() + PROBE_GEN[build_config] + PROBE_REPORT
+        res = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, check=True)
+        imported = set(res.stdout.split())
+
+        candidates = set(packages_distributions()) | set(STDLIB_EXCLUDE_CANDIDATES)
+        candidates |= {os.path.splitext(os.path.basename(path))[0] for path in glob.glob('*.py')}
+        # Runtime hooks of PyInstaller itself are always needed
+        candidates = {name for name in candidates if not name.lower().lstrip('_').startswith('pyinstaller')}
+        return sorted(name for name in candidates - imported if name.isidentifier() and name != 'main')
+
     def build(self, build_config: str) -> None:
         tmp_file = self._init_tmp(build_config)
 
-        subprocess.run([
-            'pyinstaller',
-            *CONFIGS[build_config],
-            '--log-level', 'TRACE',
-            '--onefile',
-            tmp_file
-        ])
-        os.remove(tmp_file)
+        # Generated file is removed after failed build too, otherwise next builds can't create it
+        try:
+            if self.profile == 'startup':
+                excludes = [arg for name in self._unused_modules(build_config) for arg in ('--exclude-module', name)]
+                subprocess.run([
+                    'pyinstaller',
+                    *CONFIGS[build_config],
+                    *excludes,
+                    '--name', 'main',
+                    '--log-level', 'WARN',
+                    '--onedir',
+                    '--noupx',
+                    '--optimize', '1',
+                    '--noconfirm',
+                    tmp_file
+                ], check=True)
+            else:
+                subprocess.run([
+                    'pyinstaller',
+                    *CONFIGS[build_config],
+                    '--name', 'main',
+                    '--log-level', 'TRACE',
+                    '--onefile',
+                    tmp_file
+                ])
+        finally:
+            os.remove(tmp_file)
+
+        if self.profile == 'startup':
+            binary = os.path.join('dist', 'main', 'main.exe' if os.name == 'nt' else 'main')
+            cold, warm = measure_startup(binary, build_config)
+            print(f"Startup of {binary}: cold {cold:.2f} s, warm median {warm:.2f} s")
+
+
+def measure_startup(binary: str, build_config: str, runs: int = 5, timeout: float = 60.0) -> T.Tuple[float, float]:
+    """
+    Returns seconds from launch until server accepts connections or until client shows its first frame
+    for the first (cold) run and median of next (warm) runs.
+    """
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+
+        if build_config == 'server':
+            process = subprocess.Popen([binary])
+            address = (os.getenv('SERVER_HOST') or 'localhost', int(os.environ['SERVER_PORT']))
+            try:
+                while True:
+                    if time.perf_counter() - started > timeout or process.poll() is not None:
+                        raise RuntimeError(f"Server {binary} didn't start")
+                    try:
+                        socket.create_connection(address, timeout=0.1).close()
+                        break
+                    except OSError:
+                        time.sleep(0.01)
+            finally:
+                process.terminate()
+                process.wait()
+        else:
+            subprocess.run([binary], env={**os.environ, 'EXIT_ON_START': '1'}, timeout=timeout, check=True)
+
+        times.append(time.perf_counter() - started)
+    return times[0], statistics.median(times[1:]) if len(times) > 1 else times[0]
 
 
 class MobileBuilder(Builder):
@@ -169,14 +436,56 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--run', type=str, default=None, choices=['server', 'client'])
     parser.add_argument('--build', type=str, default=None, choices=['server', 'client'])
+    parser.add_argument('--profile', type=str, default='default', choices=['default', 'startup'])
     parser.add_argument('--platform', type=str, default=None, choices=['desktop', 'mobile'])
+    parser.add_argument('--snapshot', type=str, default=None, help='dump all users data to snapshot directory')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--dedupe-users', action='store_true', help='merge duplicate users and make user_id unique')
+    parser.add_argument('--migrate-buckets', action='store_true', help='move user items to monthly buckets')
+    parser.add_argument('--migrate-encoding', action='store_true', help='upgrade buckets to compact items encoding')
+    parser.add_argument('--archive', action='store_true', help='move old item buckets to archive collection')
+    parser.add_argument('--archive-rate', type=float, default=None, help='archived buckets per second')
+    parser.add_argument('--report', type=str, default=None, help='write spending report of all users to json file')
+    parser.add_argument('--from-snapshot', type=str, default=None, help='read report data from snapshot directory')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--trace-view', type=str, nargs='+', default=None, help='summarize spans of trace files')
+    parser.add_argument('--loadtest', action='store_true', help='run load test against server')
+    parser.add_argument('--target', type=str, default=None, help='load test server host:port')
+    parser.add_argument('--users', type=int, default=10, help='load test virtual users')
+    parser.add_argument('--duration', type=float, default=30.0, help='load test duration in seconds')
+    parser.add_argument('--rate', type=float, default=None, help='open-loop requests per second')
+    parser.add_argument('--mix', type=str, default=None, help='operations weights, e.g. get_data_by_id=70,add_data_by_id=30')
     args = parser.parse_args()
 
+    if args.snapshot is not None:
+        snapshot(args.snapshot, args.batch_size)
+
+    if args.dedupe_users:
+        dedupe_users()
+
+    if args.migrate_buckets:
+        migrate_buckets(args.batch_size)
+
+    if args.migrate_encoding:
+        migrate_encoding(args.batch_size, args.workers)
+
+    if args.archive:
+        archive(args.batch_size, args.archive_rate)
+
+    if args.report is not None:
+        report(args.report, args.from_snapshot, args.batch_size, args.workers)
+
+    if args.trace_view is not None:
+        trace_view(args.trace_view)
+
+    if args.loadtest:
+        loadtest(args.target, args.users, args.duration, args.mix, args.rate)
+
     if args.build is not None:
         builder: Builder
 
         if args.platform == 'desktop':
-            builder = DesktopBuilder()
+            builder = DesktopBuilder(args.profile)
         elif args.platform == 'mobile':
             builder = MobileBuilder()
         else:
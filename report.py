@@ -0,0 +1,237 @@
+import json
+import heapq
+import collections
+import multiprocessing
+
+import numpy as np
+import typing as T  # noqa
+
+from concurrent.futures import ProcessPoolExecutor
+from database import AppDatabase
+from snapshot import SnapshotDatabase, to_epoch
+
+
+PERCENTILES = (5, 25, 50, 75, 95, 99)
+# Edges of log-spaced histogram bins of prices and user totals, from 0.01 to 10^9 with ~2% relative width,
+# values out of range fall to the first or the last bin. Histograms of chunks are merged by addition.
+HISTOGRAM_EDGES = np.concatenate([[-np.inf], np.logspace(-2, 9, 1101), [np.inf]])
+
+
+# Users of chunk, indexes of snapshot users or user ids of other databases
+Partition = T.Union[range, T.List[str]]
+
+
+class Chunk(T.NamedTuple):
+    user_ids: T.List[str]
+    # index of item user in `user_ids`
+    users: np.ndarray
+    descriptions: np.ndarray
+    times: np.ndarray
+    prices: np.ndarray
+
+
+class PartialReport(T.NamedTuple):
+    users: int
+    # (total, user_id) of users with largest totals, in descending order
+    top_users: T.List[T.Tuple[float, str]]
+    user_totals_histogram: np.ndarray
+    monthly_totals: T.Dict[int, float]
+    description_counts: T.Dict[str, int]
+    description_totals: T.Dict[str, float]
+    prices_histogram: np.ndarray
+    total: float
+
+
+def histogram(values: np.ndarray) -> np.ndarray:
+    return np.bincount(
+        np.searchsorted(HISTOGRAM_EDGES, values, side='right') - 1, minlength=len(HISTOGRAM_EDGES) - 1
+    )
+
+
+def histogram_percentiles(counts: np.ndarray, percentiles: T.Sequence[float]) -> T.List[float | None]:
+    """
+    Approximates percentiles by linear interpolation inside histogram bins.
+    """
+    total = counts.sum()
+    if total == 0:
+        return [None] * len(percentiles)
+
+    cumulative = np.cumsum(counts)
+    out = []
+    for q in percentiles:
+        rank = q / 100 * total
+        i = min(int(np.searchsorted(cumulative, rank, side='left')), len(counts) - 1)
+        # Infinite edges of outer bins are replaced by the nearest finite ones
+        low = HISTOGRAM_EDGES[max(i, 1)]
+        high = HISTOGRAM_EDGES[min(i + 1, len(HISTOGRAM_EDGES) - 2)]
+        before = cumulative[i] - counts[i]
+        fraction = (rank - before) / counts[i] if counts[i] else 0.0
+        out.append(float(low + (high - low) * fraction))
+    return out
+
+
+def iter_partitions(database: AppDatabase, chunk_size: int = 1000) -> T.Iterator[Partition]:
+    """
+    Splits users of database to partitions of `chunk_size` users, only user ids are read.
+    """
+    if isinstance(database, SnapshotDatabase):
+        for start in range(0, database.meta['users'], chunk_size):
+            yield range(start, min(start + chunk_size, database.meta['users']))
+        return
+
+    after = None
+    while user_ids := database.iter_users_after(after, chunk_size):
+        yield user_ids
+        after = user_ids[-1]
+
+
+def read_chunk(database: AppDatabase, partition: Partition) -> Chunk:
+    """
+    Reads items of partition users to arrays, snapshot columns are sliced without decoding items.
+    """
+    if isinstance(partition, range):
+        return _read_snapshot_chunk(database, partition)
+
+    batch = list(database.export_users(partition))
+    items = [(i, item) for i, (_, data) in enumerate(batch) for item in data.items]
+    return Chunk(
+        user_ids=[user_id for user_id, _ in batch],
+        users=np.fromiter((i for i, _ in items), np.int64, len(items)),
+        descriptions=np.array([item.description for _, item in items], dtype=str),
+        times=np.fromiter((to_epoch(item.time) for _, item in items), np.int64, len(items)),
+        prices=np.fromiter((item.price for _, item in items), np.float64, len(items))
+    )
+
+
+def _read_snapshot_chunk(snapshot: SnapshotDatabase, users: range) -> Chunk:
+    users_offsets = snapshot.columns['users_offsets'][users.start:users.stop + 1]
+    rows = slice(int(users_offsets[0]), int(users_offsets[-1]))
+
+    offsets = snapshot.columns['descriptions_offsets'][rows.start:rows.stop + 1]
+    data = snapshot.columns['descriptions_data'][offsets[0]:offsets[-1]].tobytes()
+    offsets = (offsets - offsets[0]).tolist()
+
+    return Chunk(
+        user_ids=[snapshot.user_id(i) for i in users],
+        users=np.repeat(np.arange(len(users)), np.diff(users_offsets)),
+        descriptions=np.array([data[start:end].decode() for start, end in zip(offsets, offsets[1:])], dtype=str),
+        times=np.asarray(snapshot.columns['times'][rows]),
+        prices=np.asarray(snapshot.columns['prices'][rows])
+    )
+
+
+# Database of worker process, opened once by `_init_worker`
+_database: AppDatabase | None = None
+
+
+def _init_worker(open_database: T.Callable[[], AppDatabase]) -> None:
+    global _database
+    _database = open_database()
+
+
+def _aggregate_partition(partition: Partition, top_users: int) -> PartialReport:
+    return aggregate_chunk(read_chunk(_database, partition), top_users)
+
+
+def aggregate_chunk(chunk: Chunk, top_users: int = 20) -> PartialReport:
+    user_totals = np.bincount(chunk.users, weights=chunk.prices, minlength=len(chunk.user_ids))
+
+    # Months since epoch
+    months = chunk.times.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64)
+    unique_months, month_index = np.unique(months, return_inverse=True)
+    monthly_totals = np.bincount(month_index, weights=chunk.prices, minlength=len(unique_months))
+
+    unique_descriptions, description_index, description_counts = np.unique(
+        chunk.descriptions, return_inverse=True, return_counts=True
+    )
+    description_totals = np.bincount(description_index, weights=chunk.prices, minlength=len(unique_descriptions))
+
+    return PartialReport(
+        users=len(chunk.user_ids),
+        top_users=heapq.nlargest(top_users, zip(user_totals.tolist(), chunk.user_ids)),
+        user_totals_histogram=histogram(user_totals),
+        monthly_totals=dict(zip(unique_months.tolist(), monthly_totals.tolist())),
+        description_counts=dict(zip(unique_descriptions.tolist(), description_counts.tolist())),
+        description_totals=dict(zip(unique_descriptions.tolist(), description_totals.tolist())),
+        prices_histogram=histogram(chunk.prices),
+        total=float(chunk.prices.sum())
+    )
+
+
+def build_report(
+    open_database: T.Callable[[], AppDatabase],
+    chunk_size: int = 1000,
+    workers: int | None = None,
+    top_descriptions: int = 20,
+    top_users: int = 20
+) -> T.Dict[str, T.Any]:
+    """
+    Aggregates all users items in process pool. Main process only splits users to partitions,
+    workers read and decode their items from database opened by picklable `open_database` in each worker.
+    Percentiles are approximated by histograms of fixed size, and only `top_users` user totals are kept,
+    so memory and report size don't grow with number of users and items (except distinct descriptions).
+    """
+    users = 0
+    total = 0.0
+    top = []
+    user_totals_histogram = np.zeros(len(HISTOGRAM_EDGES) - 1, np.int64)
+    prices_histogram = np.zeros(len(HISTOGRAM_EDGES) - 1, np.int64)
+    monthly_totals = collections.Counter()
+    description_counts = collections.Counter()
+    description_totals = collections.Counter()
+
+    def merge(partial: PartialReport):
+        nonlocal users, total, top
+        users += partial.users
+        total += partial.total
+        # Each user is exported once, so top of merged chunk tops is exact
+        top = heapq.nlargest(top_users, top + partial.top_users)
+        user_totals_histogram[:] += partial.user_totals_histogram
+        prices_histogram[:] += partial.prices_histogram
+        monthly_totals.update(partial.monthly_totals)
+        description_counts.update(partial.description_counts)
+        description_totals.update(partial.description_totals)
+
+    database = open_database()
+    # Database clients run background threads, which forked workers would inherit in undefined state
+    with ProcessPoolExecutor(
+        workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(open_database,)
+    ) as pool:
+        # Bound number of chunks in flight, so whole database is never held in memory
+        max_pending = 2 * pool._max_workers  # noqa
+        pending = collections.deque()
+
+        for partition in iter_partitions(database, chunk_size):
+            if len(pending) >= max_pending:
+                merge(pending.popleft().result())
+            pending.append(pool.submit(_aggregate_partition, partition, top_users))
+
+        while pending:
+            merge(pending.popleft().result())
+
+    return {
+        'users': users,
+        'items': int(prices_histogram.sum()),
+        'total': total,
+        'top_users': [{'user_id': user_id, 'total': user_total} for user_total, user_id in top],
+        'user_total_percentiles': dict(zip(
+            map(str, PERCENTILES), histogram_percentiles(user_totals_histogram, PERCENTILES)
+        )),
+        'monthly_totals': {
+            str(np.datetime64(month, 'M')): total
+            for month, total in sorted(monthly_totals.items())
+        },
+        'price_percentiles': dict(zip(map(str, PERCENTILES), histogram_percentiles(prices_histogram, PERCENTILES))),
+        'top_descriptions': [
+            {'description': desc, 'count': count, 'total': description_totals[desc]}
+            for desc, count in description_counts.most_common(top_descriptions)
+        ]
+    }
+
+
+def write_report(report: T.Dict[str, T.Any], path: str) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
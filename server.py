@@ -1,32 +1,286 @@
 import json
+import math
+import time
+import asyncio
+import collections
 import fastapi
 import functools
+import threading
 
 import typing as T  # noqa
 
+from starlette.requests import Request
 from starlette.responses import Response
-from database import AppDatabase, UserItems
+import tracing
 
+from chart import ChartRenderer, ChartKind, ChartFormat, MEDIA_TYPES
+from database import CoalescingDatabase, UserItems, Operation, SortKey, parse_datetime, ops_from_list, ops_to_list
 
-db: AppDatabase
+
+db: CoalescingDatabase
 app = fastapi.FastAPI()
 RequestArgsKwargs = tuple[T.Any, ...], dict[str, T.Any]
 
 
-def request(
-    target: T.Callable[[RequestArgsKwargs], T.Union[str, UserItems]]
-) -> T.Callable[[RequestArgsKwargs], Response]:
-    @functools.wraps(target)
-    def _(*arg, **kwargs):
+class ChangeFeed:
+    """
+    Per-user changes publisher for websocket subscribers.
+    Events are lists of operations in `ops_to_list` format, `{'op': 'reset'}` tells subscriber to refetch all data.
+    """
+    max_queue_size: int = 1000
+
+    _loop: asyncio.AbstractEventLoop | None = None
+    _subscribers: T.Dict[str, T.Set[asyncio.Queue]]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        self._loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.max_queue_size)
+
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue) -> None:
+        with self._lock:
+            queues = self._subscribers.get(user_id, set())
+            queues.discard(queue)
+            if not queues:
+                self._subscribers.pop(user_id, None)
+
+    def publish(self, user_id: str, event: T.List[T.Dict[str, T.Any]]) -> None:
+        """
+        Thread-safe, may be called from sync endpoints running in threadpool.
+        """
+        with self._lock:
+            queues = list(self._subscribers.get(user_id, ()))
+
+        for queue in queues:
+            self._loop.call_soon_threadsafe(self._put, queue, event)
+
+    @staticmethod
+    def _put(queue: asyncio.Queue, event: T.List[T.Dict[str, T.Any]]) -> None:
+        # Slow subscriber will lose pending events, so it must refetch all data
+        if queue.full():
+            while not queue.empty():
+                queue.get_nowait()
+            event = [{'op': 'reset'}]
+        queue.put_nowait(event)
+
+
+feed = ChangeFeed()
+charts = ChartRenderer()
+
+
+def publish(user_id: str, ops: T.List[Operation]) -> None:
+    feed.publish(user_id, ops_to_list(ops))
+
+
+class TokenBucket:
+    rate: float
+    capacity: float
+
+    _tokens: float
+    _updated: float
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def wait_time(self) -> float:
+        """
+        Returns number of seconds until token will be available, 0 if it is available now.
+        """
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def take(self) -> float:
+        """
+        Takes one token, returns 0 on success or number of seconds until token will be available.
+        """
+        wait_time = self.wait_time()
+        if wait_time == 0:
+            self._tokens -= 1
+        return wait_time
+
+
+class AdmissionController:
+    """
+    Limits number of concurrently processed requests with bounded wait queue and rate of requests per `user_id`.
+    Rejected requests get 503 (server overloaded) or 429 (user rate exceeded) with `Retry-After` header.
+    User token is taken only by admitted request, buckets of `max_buckets` recently seen users are kept.
+    """
+    max_buckets: int = 10000
+
+    max_concurrency: int | None
+    max_queue: int
+    queue_timeout: float
+    rate_per_user: float | None
+    burst: float
+
+    _waiting: int = 0
+    _semaphore: asyncio.Semaphore | None = None
+    # user_id -> bucket, in order of use
+    _buckets: collections.OrderedDict
+
+    def __init__(
+        self,
+        max_concurrency: int | None = None,
+        max_queue: int = 0,
+        queue_timeout: float = 1.0,
+        rate_per_user: float | None = None,
+        burst: float | None = None
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rate_per_user = rate_per_user
+        # Bucket holding less than one token rejects every request
+        if burst is not None and burst < 1:
+            raise ValueError(f"Rate limit burst must be at least 1, got {burst}")
+        self.burst = max(1.0, rate_per_user or 0.0) if burst is None else burst
+        self._buckets = collections.OrderedDict()
+
+    async def __call__(
+        self,
+        req: Request,
+        call_next: T.Callable[[Request], T.Awaitable[Response]]
+    ) -> Response:
+        user_id = req.query_params.get('user_id')
+        bucket = None
+        if self.rate_per_user is not None and user_id is not None:
+            bucket = self._bucket(user_id)
+            # Request which would be rejected after admission doesn't wait in queue
+            retry_after = bucket.wait_time()
+            if retry_after > 0:
+                return self._reject(429, retry_after)
+
+        if self.max_concurrency is None:
+            return await self._call(req, call_next, bucket)
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        if self._semaphore.locked():
+            if self._waiting >= self.max_queue:
+                return self._reject(503, self.queue_timeout)
+
+            self._waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                return self._reject(503, self.queue_timeout)
+            finally:
+                self._waiting -= 1
+        else:
+            await self._semaphore.acquire()
+
         try:
-            res = target(*arg, **kwargs)
+            return await self._call(req, call_next, bucket)
+        finally:
+            self._semaphore.release()
+
+    async def _call(
+        self,
+        req: Request,
+        call_next: T.Callable[[Request], T.Awaitable[Response]],
+        bucket: TokenBucket | None
+    ) -> Response:
+        if bucket is not None:
+            # Concurrent requests of user may take its tokens while this one waited
+            retry_after = bucket.take()
+            if retry_after > 0:
+                return self._reject(429, retry_after)
+        return await call_next(req)
+
+    def _bucket(self, user_id: str) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+
+        if bucket is None:
+            # Least recently used bucket is dropped, it is the most likely to be full anyway
+            if len(self._buckets) >= self.max_buckets:
+                self._buckets.popitem(last=False)
+            bucket = self._buckets[user_id] = TokenBucket(self.rate_per_user, self.burst)
+        else:
+            self._buckets.move_to_end(user_id)
+        return bucket
+
+    @staticmethod
+    def _reject(status_code: int, retry_after: float) -> Response:
+        return Response(
+            content='Too many requests' if status_code == 429 else 'Server overloaded',
+            status_code=status_code,
+            headers={'Retry-After': str(max(1, math.ceil(retry_after)))}
+        )
+
+
+admission: AdmissionController | None = None
+
+
+@app.middleware('http')
+async def admit(req: Request, call_next: T.Callable[[Request], T.Awaitable[Response]]) -> Response:
+    if admission is None:
+        return await call_next(req)
+    return await admission(req, call_next)
+
+
+@app.middleware('http')
+async def trace(req: Request, call_next: T.Callable[[Request], T.Awaitable[Response]]) -> Response:
+    if not tracing.enabled():
+        return await call_next(req)
+
+    # Span includes admission wait, endpoint runs in context copied from this one
+    with tracing.continue_trace(req.headers.get(tracing.TRACE_HEADER), req.headers.get(tracing.PARENT_SPAN_HEADER)):
+        with tracing.span(f'http.{req.url.path.lstrip("/")}') as attrs:
+            res = await call_next(req)
+            attrs['status'] = res.status_code
+            return res
+
+
+def _response(res: T.Union[str, list, dict, UserItems, Response]) -> Response:
+    if isinstance(res, Response):
+        return res
+
+    with tracing.span('json.encode'):
+        if isinstance(res, UserItems):
+            res = json.dumps(res.to_dict())
+        elif isinstance(res, (list, dict)):
+            res = json.dumps(res)
+    return Response(content=res, status_code=200)
 
-            if isinstance(res, UserItems):
-                res = json.dumps(res.to_dict())
-            return Response(content=res, status_code=200)
 
-        except Exception as ex:
-            return Response(content=str(ex), status_code=404)
+def request(
+    target: T.Callable[[RequestArgsKwargs], T.Union[str, UserItems, Response]]
+) -> T.Callable[[RequestArgsKwargs], Response]:
+    """
+    Wraps endpoint, sync endpoints run in threadpool and async ones run in event loop.
+    """
+    if asyncio.iscoroutinefunction(target):
+        @functools.wraps(target)
+        async def _(*arg, **kwargs):
+            with tracing.span(f'endpoint.{target.__name__}'):
+                try:
+                    return _response(await target(*arg, **kwargs))
+                except Exception as ex:
+                    return Response(content=str(ex), status_code=404)
+    else:
+        @functools.wraps(target)
+        def _(*arg, **kwargs):
+            with tracing.span(f'endpoint.{target.__name__}'):
+                try:
+                    return _response(target(*arg, **kwargs))
+                except Exception as ex:
+                    return Response(content=str(ex), status_code=404)
 
     _.__annotations__ = target.__annotations__  # noqa
     _.__name__ = target.__name__
@@ -39,7 +293,9 @@ def create_user(
     body: dict = fastapi.Body(dict()),
     user_id: str = fastapi.Query()
 ):
-    db.create_user(user_id, UserItems.from_dict(body))
+    data = UserItems.from_dict(body)
+    db.create_user(user_id, data)
+    publish(user_id, [('set', data)])
     return 'Success'
 
 
@@ -49,25 +305,74 @@ def delete_user(
     user_id: str = fastapi.Query()
 ):
     db.delete_user(user_id)
+    feed.publish(user_id, [{'op': 'reset'}])
     return 'Success'
 
 
+# Hot reads are coalesced in event loop, so concurrent identical requests don't hold threadpool workers
 @app.get('/get_data_by_id')
 @request
-def get_data_by_id(
-    user_id: str = fastapi.Query()
+async def get_data_by_id(
+    user_id: str = fastapi.Query(),
+    since: str | None = fastapi.Query(None),
+    until: str | None = fastapi.Query(None),
+    min_price: float | None = fastapi.Query(None),
+    max_price: float | None = fastapi.Query(None),
+    limit: int | None = fastapi.Query(None)
 ):
-    data = db.get_data_by_id(user_id)
+    data = await db.get_data_by_id_async(
+        user_id,
+        since=parse_datetime(since),
+        until=parse_datetime(until),
+        min_price=min_price,
+        max_price=max_price,
+        limit=limit
+    )
     return data
 
 
+@app.get('/get_items_page')
+@request
+def get_items_page(
+    user_id: str = fastapi.Query(),
+    page: int = fastapi.Query(0),
+    page_size: int = fastapi.Query(20),
+    sort_key: SortKey = fastapi.Query('time'),
+    sort_desc: bool = fastapi.Query(False)
+):
+    items, total = db.get_items_page(user_id, page, page_size, sort_key, sort_desc)
+    return {'items': items.to_dict(), 'total': total}
+
+
+@app.get('/get_summary')
+@request
+def get_summary(
+    user_id: str = fastapi.Query()
+):
+    return db.get_summary(user_id).to_dict()
+
+
 @app.post('/add_data_by_id')
 @request
 def add_data_by_id(
     body: dict = fastapi.Body(),
     user_id: str = fastapi.Query()
 ):
-    db.add_data_by_id(user_id, UserItems.from_dict(body))
+    data = UserItems.from_dict(body)
+    db.add_data_by_id(user_id, data)
+    publish(user_id, [('set', data)])
+    return 'Success'
+
+
+@app.post('/upsert_data_by_id')
+@request
+def upsert_data_by_id(
+    body: dict = fastapi.Body(dict()),
+    user_id: str = fastapi.Query()
+):
+    data = UserItems.from_dict(body)
+    db.upsert_data_by_id(user_id, data)
+    publish(user_id, [('set', data)])
     return 'Success'
 
 
@@ -78,28 +383,110 @@ def delete_data_by_id(
     user_id: str = fastapi.Query()
 ):
     db.delete_data_by_id(user_id, body)
+    publish(user_id, [('unset', body)])
+    return 'Success'
+
+
+@app.post('/apply_ops')
+@request
+def apply_ops(
+    body: list = fastapi.Body(),
+    user_id: str = fastapi.Query()
+):
+    ops = ops_from_list(body)
+    db.apply_ops(user_id, ops)
+    publish(user_id, ops)
     return 'Success'
 
 
 @app.get('/iter_all_users')
 @request
-def iter_all_users(
+async def iter_all_users(
     pid: int = fastapi.Query(),
     n: int = fastapi.Query()
 ):
-    data = db.iter_all_users(pid, n)
+    data = await db.iter_all_users_async(pid, n)
     return data
 
 
+@app.get('/iter_users_after')
+@request
+def iter_users_after(
+    after: str | None = fastapi.Query(None),
+    n: int = fastapi.Query()
+):
+    return db.iter_users_after(after, n)
+
+
+@app.get('/changes_since')
+@request
+def changes_since(
+    user_id: str = fastapi.Query(),
+    version: int = fastapi.Query(0),
+    epoch: str | None = fastapi.Query(None)
+):
+    return db.changes_since(user_id, version, epoch).to_dict()
+
+
+@app.get('/chart')
+@request
+def chart(
+    user_id: str = fastapi.Query(),
+    kind: ChartKind = fastapi.Query('pie'),
+    image_format: ChartFormat = fastapi.Query('png', alias='format')
+):
+    image = charts.render(db, user_id, kind, image_format)
+    return Response(content=image, status_code=200, media_type=MEDIA_TYPES[image_format])
+
+
+@app.websocket('/changes')
+async def changes(
+    websocket: fastapi.WebSocket,
+    user_id: str = fastapi.Query()
+):
+    await websocket.accept()
+    queue = feed.subscribe(user_id)
+
+    async def send() -> None:
+        while True:
+            await websocket.send_json(await queue.get())
+
+    async def receive() -> None:
+        # Clients send nothing, so it waits for disconnect of idle subscriber
+        while (await websocket.receive())['type'] != 'websocket.disconnect':
+            pass
+
+    tasks = [asyncio.ensure_future(send()), asyncio.ensure_future(receive())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        feed.unsubscribe(user_id, queue)
+        for task in tasks:
+            task.cancel()
+        # Send to disconnected client fails with transport specific errors, connection is closed anyway
+        for task in tasks:
+            if task.done() and not task.cancelled():
+                task.exception()
+
+
 def run(dotenv_path: str = None):
-    global db, app
+    global db, app, admission
     import const
 
     if dotenv_path:
         const.load_dotenv(dotenv_path)
 
     from database import Database
-    db = Database()
+    db = CoalescingDatabase(Database())
+
+    if const.ADMISSION_MAX_CONCURRENCY or const.RATE_LIMIT_PER_USER:
+        admission = AdmissionController(
+            max_concurrency=int(const.ADMISSION_MAX_CONCURRENCY) if const.ADMISSION_MAX_CONCURRENCY else None,
+            max_queue=int(const.ADMISSION_MAX_QUEUE) if const.ADMISSION_MAX_QUEUE else 0,
+            queue_timeout=float(const.ADMISSION_QUEUE_TIMEOUT) if const.ADMISSION_QUEUE_TIMEOUT else 1.0,
+            rate_per_user=float(const.RATE_LIMIT_PER_USER) if const.RATE_LIMIT_PER_USER else None,
+            burst=float(const.RATE_LIMIT_BURST) if const.RATE_LIMIT_BURST else None
+        )
 
     import uvicorn
     uvicorn.run(app=app, host=const.SERVER_HOST, port=int(const.SERVER_PORT))
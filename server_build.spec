@@ -10,7 +10,7 @@ a = Analysis(
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=['client', 'matplotlib', 'matplotlib.pyplot', 'prompt_toolkit', 'PySide2', 'PyQt6'],
+    excludes=['client', 'matplotlib.pyplot', 'prompt_toolkit', 'PySide2', 'PyQt6'],
     noarchive=False,
     optimize=0,
 )
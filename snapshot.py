@@ -0,0 +1,217 @@
+import os
+import json
+import bisect
+
+import numpy as np
+import typing as T  # noqa
+
+from datetime import datetime, timedelta
+from database import AppDatabase, UserItems, Item, Operation
+
+
+EPOCH = datetime(1970, 1, 1)
+SNAPSHOT_VERSION = 1
+
+# Snapshot is a directory of raw little-endian column files, strings are stored as utf-8 data + offsets.
+# Items are grouped by user, items of user `i` are rows `users_offsets[i]:users_offsets[i+1]`.
+COLUMNS = {
+    'user_ids_data': np.uint8,
+    'user_ids_offsets': np.int64,
+    'users_offsets': np.int64,
+    'descriptions_data': np.uint8,
+    'descriptions_offsets': np.int64,
+    'times': np.int64,
+    'prices': np.float64
+}
+
+
+def to_epoch(time: datetime) -> int:
+    return int((time - EPOCH).total_seconds())
+
+
+def from_epoch(seconds: int) -> datetime:
+    return EPOCH + timedelta(seconds=int(seconds))
+
+
+class _ColumnWriter:
+    def __init__(self, path: str, dtype: T.Type[np.generic]):
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.length = 0
+        self._file = open(path, 'wb')
+
+    def write(self, values: T.Iterable[T.Any] | bytes) -> None:
+        array = np.frombuffer(values, self.dtype) if isinstance(values, bytes) else np.asarray(values, self.dtype)
+        self._file.write(array.tobytes())
+        self.length += len(array)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def write_snapshot(database: AppDatabase, path: str, batch_size: int = 100) -> T.Dict[str, int]:
+    """
+    Streams all users from database to snapshot directory, returns snapshot meta.
+    """
+    os.makedirs(path, exist_ok=True)
+    writers = {name: _ColumnWriter(os.path.join(path, f'{name}.bin'), dtype) for name, dtype in COLUMNS.items()}
+
+    users = 0
+    items = 0
+    user_ids_size = 0
+    descriptions_size = 0
+    writers['user_ids_offsets'].write([0])
+    writers['users_offsets'].write([0])
+    writers['descriptions_offsets'].write([0])
+
+    try:
+        for user_id, data in database.export(batch_size):
+            encoded_user_id = user_id.encode()
+            user_ids_size += len(encoded_user_id)
+            writers['user_ids_data'].write(encoded_user_id)
+            writers['user_ids_offsets'].write([user_ids_size])
+
+            descriptions = [item.description.encode() for item in data.items]
+            writers['descriptions_data'].write(b''.join(descriptions))
+            writers['descriptions_offsets'].write(descriptions_size + np.cumsum([len(d) for d in descriptions]))
+            descriptions_size += sum(len(d) for d in descriptions)
+
+            writers['times'].write([to_epoch(item.time) for item in data.items])
+            writers['prices'].write([item.price for item in data.items])
+
+            users += 1
+            items += len(data.items)
+            writers['users_offsets'].write([items])
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    meta = {'version': SNAPSHOT_VERSION, 'users': users, 'items': items}
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+class _UserIds(T.Sequence[str]):
+    """
+    Lazy sequence of snapshot user ids for binary search.
+    """
+    def __init__(self, snapshot: 'SnapshotDatabase'):
+        self._snapshot = snapshot
+
+    def __len__(self) -> int:
+        return self._snapshot.meta['users']
+
+    def __getitem__(self, i: int) -> str:
+        return self._snapshot.user_id(i)
+
+
+class SnapshotDatabase(AppDatabase):
+    """
+    Read-only database over memory-mapped snapshot written by `write_snapshot`.
+    """
+    path: str
+    meta: T.Dict[str, int]
+    columns: T.Dict[str, np.ndarray]
+
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {self.meta['version']}")
+
+        self.columns = {}
+        for name, dtype in COLUMNS.items():
+            column_path = os.path.join(path, f'{name}.bin')
+            dtype = np.dtype(dtype).newbyteorder('<')
+
+            # Empty files can't be memory-mapped
+            if os.path.getsize(column_path) == 0:
+                self.columns[name] = np.empty(0, dtype)
+            else:
+                self.columns[name] = np.memmap(column_path, dtype, mode='r')
+
+    @staticmethod
+    def _string(data: np.ndarray, offsets: np.ndarray, i: int) -> str:
+        return data[offsets[i]:offsets[i+1]].tobytes().decode()
+
+    def user_id(self, i: int) -> str:
+        return self._string(self.columns['user_ids_data'], self.columns['user_ids_offsets'], i)
+
+    def user_index(self, user_id: str) -> int | None:
+        # Users are written in `user_id` order, so only O(log n) user ids are decoded
+        user_ids = _UserIds(self)
+        i = bisect.bisect_left(user_ids, user_id)
+        if i < len(user_ids) and user_ids[i] == user_id:
+            return i
+        return None
+
+    def user_rows(self, user_id: str) -> slice:
+        i = self.user_index(user_id)
+        if i is None:
+            return slice(0, 0)
+        return slice(int(self.columns['users_offsets'][i]), int(self.columns['users_offsets'][i+1]))
+
+    def get_data_by_id(
+        self,
+        user_id: str,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        limit: int | None = None
+    ) -> UserItems:
+        rows = self.user_rows(user_id)
+        times = self.columns['times'][rows]
+        prices = self.columns['prices'][rows]
+
+        mask = np.ones(len(times), bool)
+        if since is not None:
+            mask &= times >= to_epoch(since)
+        if until is not None:
+            mask &= times <= to_epoch(until)
+        if min_price is not None:
+            mask &= prices >= min_price
+        if max_price is not None:
+            mask &= prices <= max_price
+
+        indexes = np.flatnonzero(mask)
+        if limit is not None:
+            indexes = indexes[np.argsort(-times[indexes], kind='stable')[:limit]]
+
+        data = self.columns['descriptions_data']
+        offsets = self.columns['descriptions_offsets']
+        return UserItems([
+            Item(
+                description=self._string(data, offsets, rows.start + i),
+                time=from_epoch(times[i]),
+                price=float(prices[i])
+            )
+            for i in indexes
+        ])
+
+    def iter_all_users(self, pid: int, n: int) -> T.List[str]:
+        return [self.user_id(i) for i in range(pid*n, min((pid+1)*n, self.meta['users']))]
+
+    def iter_users_after(self, after: str | None, n: int) -> T.List[str]:
+        first = 0 if after is None else bisect.bisect_right(_UserIds(self), after)
+        return [self.user_id(i) for i in range(first, min(first + n, self.meta['users']))]
+
+    def create_user(self, user_id: str, init_data: UserItems | None = None) -> None:
+        raise NotImplementedError("Snapshot database is read-only")
+
+    def delete_user(self, user_id: str) -> None:
+        raise NotImplementedError("Snapshot database is read-only")
+
+    def add_data_by_id(self, user_id: str, data: UserItems) -> None:
+        raise NotImplementedError("Snapshot database is read-only")
+
+    def upsert_data_by_id(self, user_id: str, data: UserItems) -> None:
+        raise NotImplementedError("Snapshot database is read-only")
+
+    def delete_data_by_id(self, user_id: str, fields: T.List[str]) -> None:
+        raise NotImplementedError("Snapshot database is read-only")
+
+    def apply_ops(self, user_id: str, ops: T.List[Operation]) -> None:
+        raise NotImplementedError("Snapshot database is read-only")
@@ -0,0 +1,117 @@
+import pytest
+
+import typing as T  # noqa
+
+from datetime import datetime
+from database import AppDatabase, ShardedDatabase, UserItems, Item
+
+
+class MemoryDatabase(AppDatabase):
+    """
+    Dict-backed shard: {user_id: {description: Item}}.
+    """
+    def __init__(self):
+        self.users: T.Dict[str, T.Dict[str, Item]] = {}
+
+    def create_user(self, user_id: str, init_data: UserItems | None = None) -> None:
+        self.users[user_id] = {}
+        if init_data is not None:
+            self.add_data_by_id(user_id, init_data)
+
+    def delete_user(self, user_id: str) -> None:
+        self.users.pop(user_id, None)
+
+    def get_data_by_id(
+        self,
+        user_id: str,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        limit: int | None = None
+    ) -> UserItems:
+        return UserItems(list(self.users.get(user_id, {}).values()))
+
+    def add_data_by_id(self, user_id: str, data: UserItems) -> None:
+        if user_id in self.users:
+            self.users[user_id].update({item.description: item for item in data.items})
+
+    def upsert_data_by_id(self, user_id: str, data: UserItems) -> None:
+        self.users.setdefault(user_id, {})
+        self.add_data_by_id(user_id, data)
+
+    def delete_data_by_id(self, user_id: str, fields: T.List[str]) -> None:
+        for field in fields:
+            self.users.get(user_id, {}).pop(field, None)
+
+    def iter_all_users(self, pid: int, n: int) -> T.List[str]:
+        return sorted(self.users)[pid*n:(pid+1)*n]
+
+
+USER_IDS = [f'user{i:03}' for i in range(100)]
+
+
+def items(user_id: str) -> UserItems:
+    return UserItems(Item(f'{user_id}-item', 1.0, datetime(2024, 1, 1)))
+
+
+@pytest.fixture
+def sharded() -> ShardedDatabase:
+    database = ShardedDatabase({name: MemoryDatabase() for name in ('a', 'b', 'c')})
+    for user_id in USER_IDS:
+        database.create_user(user_id, items(user_id))
+    return database
+
+
+def test_routing(sharded):
+    for user_id in USER_IDS:
+        owner = sharded.shard_name(user_id)
+        assert [name for name, shard in sharded.shards.items() if user_id in shard.users] == [owner]
+        assert sharded.get_data_by_id(user_id) == items(user_id)
+
+    # Every shard owns some users
+    assert all(shard.users for shard in sharded.shards.values())
+
+
+def test_routing_is_stable():
+    first = ShardedDatabase({name: MemoryDatabase() for name in ('a', 'b', 'c')})
+    second = ShardedDatabase({name: MemoryDatabase() for name in ('c', 'a', 'b')})
+    assert [first.shard_name(u) for u in USER_IDS] == [second.shard_name(u) for u in USER_IDS]
+
+
+def test_merged_iteration(sharded):
+    assert [u for pid in range(7) for u in sharded.iter_all_users(pid, 15)] == USER_IDS
+
+    after, users = None, []
+    while page := sharded.iter_users_after(after, 15):
+        users += page
+        after = page[-1]
+    assert users == USER_IDS
+
+    assert [(user_id, data) for user_id, data in sharded.export(15)] == [(u, items(u)) for u in USER_IDS]
+
+
+def test_export_users(sharded):
+    # Users of different shards are returned in requested order
+    user_ids = USER_IDS[::-7]
+    assert list(sharded.export_users(user_ids)) == [(u, items(u)) for u in user_ids]
+
+
+def test_add_shard(sharded):
+    before = {name: set(shard.users) for name, shard in sharded.shards.items()}
+    new_shard = MemoryDatabase()
+
+    moved = sharded.add_shard('d', new_shard, batch_size=7)
+
+    assert moved == len(new_shard.users) > 0
+    for user_id in USER_IDS:
+        assert sharded.shard_name(user_id) in ('d', *[name for name, users in before.items() if user_id in users])
+        assert sharded.get_data_by_id(user_id) == items(user_id)
+    # Moved users are removed from old shards
+    assert sum(len(shard.users) for shard in sharded.shards.values()) == len(USER_IDS)
+    assert [u for pid in range(7) for u in sharded.iter_all_users(pid, 15)] == USER_IDS
+
+
+def test_add_existing_shard(sharded):
+    with pytest.raises(ValueError):
+        sharded.add_shard('a', MemoryDatabase())
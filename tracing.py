@@ -0,0 +1,204 @@
+import json
+import time
+import uuid
+import threading
+import contextlib
+import contextvars
+
+import typing as T  # noqa
+
+from pymongo import monitoring
+
+
+# Headers which propagate trace from WebDatabase to server
+TRACE_HEADER = 'X-Trace-Id'
+PARENT_SPAN_HEADER = 'X-Parent-Span-Id'
+
+
+class Span(T.NamedTuple):
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    name: str
+    # wall clock start and duration in microseconds
+    start: int
+    duration: int
+    attrs: T.Dict[str, T.Any]
+
+
+class FileExporter:
+    """
+    Appends spans to file as json lines, so client and server may export to the same file.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(span._asdict(), default=str) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+_exporter: FileExporter | None = None
+# (trace_id, span_id) of current span
+_current: contextvars.ContextVar[T.Tuple[str, str | None] | None] = contextvars.ContextVar('trace', default=None)
+
+
+def configure(path: str | None) -> None:
+    """
+    Enables export of spans to file, tracing is disabled while not configured.
+    """
+    global _exporter
+    if _exporter is not None:
+        _exporter.close()
+    _exporter = None if path is None else FileExporter(path)
+
+
+def enabled() -> bool:
+    return _exporter is not None
+
+
+def _new_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def current() -> T.Tuple[str, str | None] | None:
+    return _current.get()
+
+
+@contextlib.contextmanager
+def continue_trace(trace_id: str | None, parent_id: str | None = None) -> T.Iterator[None]:
+    """
+    Makes spans inside context children of remote `parent_id` span, new trace is started if `trace_id` is None.
+    """
+    token = _current.set((trace_id or uuid.uuid4().hex, parent_id))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs: T.Any) -> T.Iterator[T.Dict[str, T.Any]]:
+    """
+    Records span of context, yields its attributes dict, which may be updated inside context.
+    New trace is started if there is no current one.
+    """
+    if _exporter is None:
+        yield attrs
+        return
+
+    parent = _current.get()
+    trace_id, parent_id = parent if parent is not None else (uuid.uuid4().hex, None)
+    span_id = _new_id()
+    token = _current.set((trace_id, span_id))
+
+    start = time.time_ns() // 1000
+    started = time.perf_counter_ns()
+    try:
+        yield attrs
+    except BaseException as ex:
+        attrs['error'] = type(ex).__name__
+        raise
+    finally:
+        duration = (time.perf_counter_ns() - started) // 1000
+        _current.reset(token)
+        exporter = _exporter
+        if exporter is not None:
+            exporter.export(Span(trace_id, span_id, parent_id, name, start, duration, attrs))
+
+
+class CommandTracer(monitoring.CommandListener):
+    """
+    Records span of each pymongo command, listener is called in the thread which sends the command,
+    so command spans are children of current span.
+    """
+    def __init__(self):
+        self._started: T.Dict[int, T.Tuple[T.Tuple[str, str | None] | None, int, int, str, str]] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if _exporter is None:
+            return
+        self._started[event.request_id] = (
+            _current.get(), time.time_ns() // 1000, time.perf_counter_ns(), event.command_name, event.database_name
+        )
+
+    def _finish(self, event: T.Union[monitoring.CommandSucceededEvent, monitoring.CommandFailedEvent]) -> None:
+        started = self._started.pop(event.request_id, None)
+        exporter = _exporter
+        if started is None or exporter is None:
+            return
+
+        parent, start, started_ns, command, database = started
+        trace_id, parent_id = parent if parent is not None else (uuid.uuid4().hex, None)
+        attrs = {'database': database}
+        if isinstance(event, monitoring.CommandFailedEvent):
+            attrs['error'] = str(event.failure.get('errmsg', ''))
+
+        exporter.export(Span(
+            trace_id, _new_id(), parent_id, f'mongo.{command}', start,
+            (time.perf_counter_ns() - started_ns) // 1000, attrs
+        ))
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finish(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finish(event)
+
+
+def read_spans(paths: T.Iterable[str]) -> T.List[Span]:
+    spans = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            spans += [Span(**json.loads(line)) for line in f if line.strip()]
+    return spans
+
+
+def critical_path(root: Span, children: T.Dict[str, T.List[Span]]) -> T.List[Span]:
+    """
+    Chain of spans from root which determines its end: at each level the child which ends last.
+    """
+    path = [root]
+    while kids := children.get(path[-1].span_id):
+        path.append(max(kids, key=lambda s: s.start + s.duration))
+    return path
+
+
+def summarize(spans: T.List[Span], top: int = 10) -> str:
+    """
+    Formats slowest traces with their critical paths and total self time of spans by name
+    (span duration minus durations of its children).
+    """
+    children: T.Dict[str, T.List[Span]] = {}
+    ids = {s.span_id for s in spans}
+    roots = []
+    for s in spans:
+        if s.parent_id is not None and s.parent_id in ids:
+            children.setdefault(s.parent_id, []).append(s)
+        else:
+            roots.append(s)
+
+    self_times: T.Dict[str, int] = {}
+    counts: T.Dict[str, int] = {}
+    for s in spans:
+        self_time = s.duration - sum(c.duration for c in children.get(s.span_id, []))
+        self_times[s.name] = self_times.get(s.name, 0) + max(0, self_time)
+        counts[s.name] = counts.get(s.name, 0) + 1
+
+    lines = [f"{len(spans)} spans, {len(roots)} traces", '', f"Slowest {min(top, len(roots))} traces:"]
+    for root in sorted(roots, key=lambda s: -s.duration)[:top]:
+        lines.append(f"  trace {root.trace_id} {root.duration / 1000:.1f} ms")
+        for depth, s in enumerate(critical_path(root, children)):
+            lines.append(f"    {'  ' * depth}{s.name} {s.duration / 1000:.1f} ms {s.attrs or ''}".rstrip())
+
+    lines += ['', f"{'span':<40}{'count':>8}{'self ms':>12}{'avg self ms':>14}"]
+    for name, total in sorted(self_times.items(), key=lambda name_total: -name_total[1]):
+        lines.append(f"{name:<40}{counts[name]:>8}{total / 1000:>12.1f}{total / 1000 / counts[name]:>14.2f}")
+    return '\n'.join(lines)